@@ -1,19 +1,479 @@
 import numpy as np
-import logging
-from datetime import datetime, date
+import logging, pickle, os, hashlib, heapq, weakref, json, threading, queue, itertools
+from pathlib import Path
+from datetime import datetime, date, timedelta
+from functools import partial
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing.connection import Listener, Client
+from multiprocessing.shared_memory import SharedMemory
+
+
+# The default objective: backtest the trading strategy for a parameter set and score it by net profit
+def trading_objective(data_file, param_set):
+
+    trades, liquid_cash_history, ticker_data, BAH_data = sim.test_strategy(data_file, param_set)
+    res = o_a.analyse_trades(trades, liquid_cash_history, ticker_data, param_set, BAH_data)
+
+    return res['net_profit']
+
+
+# Identifies an objective across restarts by its qualified name (or that of its class, for callable instances, and with its
+# arguments, for partials), so that checkpointed results are only reused for the objective which calculated them. Lambdas,
+# closures and instances of one class share a name, so they need an explicit GridSearch objective_id to be told apart.
+def _objective_name(objective):
+
+    if isinstance(objective, partial):
+        arguments = [repr(arg) for arg in objective.args] + ['{}={!r}'.format(name, value) for name, value in objective.keywords.items()]
+        return 'partial({})'.format(', '.join([_objective_name(objective.func)] + arguments))
+    if not hasattr(objective, '__qualname__'):
+        objective = type(objective)
+
+    return '{}.{}'.format(objective.__module__, objective.__qualname__)
+
+
+def _hashable_or_id(obj):
+
+    try:
+        hash(obj)
+    except TypeError:
+        return 'id', id(obj)
+
+    return obj
+
+
+# Evaluates a list of parameter sets in order (module level so that it can be pickled and sent to worker processes)
+def _evaluate_param_sets(objective, data_file, param_sets):
+
+    if isinstance(data_file, SharedDataset):
+        data_file = data_file.get_data()
+
+    return [objective(data_file, param_set) for param_set in param_sets]
+
+
+# Evaluates a chunk of combos with a batch objective, which is called as objective(data_file, columns) where columns maps each
+# parameter to an array of its values in the chunk (or the value itself for constants), and must return a vector of results
+def _evaluate_batch(objective, data_file, columns, n_combos):
+
+    if isinstance(data_file, SharedDataset):
+        data_file = data_file.get_data()
+    results = np.asarray(objective(data_file, columns), dtype=float).reshape(-1)
+    if results.size != n_combos:
+        raise Exception('Batch objective returned {} results for a chunk of {} parameter combos.'.format(results.size, n_combos))
+
+    return results
+
+
+# Converts the NumPy, date and other values found in parameter sets for JSON export
+def _json_default(value):
+
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, date):
+        return value.isoformat()
+    return repr(value)
+
+
+# Lazily loaded grid exported by GridSearch.export_grid: the metadata is read on opening, and each array only when accessed
+class GridSearchArchive:
+
+    def __init__(self, filepath):
+
+        self.filepath = Path(filepath)
+        self._npz = np.load(str(self.filepath))
+        self.metadata = json.loads(str(self._npz['metadata']))
+        self.parameters = self.metadata['parameters']
+        self.vectorised_parameters = self.metadata['vectorised_parameters']
+        self.cycle = self.metadata['cycle']
+        self.extremum = self.metadata['extremum']
+        self.extremum_param_set = self.metadata['extremum_param_set']
+
+    @property
+    def results(self):
+        return self._npz['results']
+
+    @property
+    def completed(self):
+        return self._npz['completed']
+
+    @property
+    def parameter_vectors(self):
+
+        parameter_vectors = {parameter: self._npz['vector__{}'.format(parameter)] for parameter in self.vectorised_parameters}
+        parameter_vectors.update(self.metadata['nonvectorised_parameters'])
+
+        return parameter_vectors
+
+    def close(self):
+        self._npz.close()
+
+    # The archives of every exported cycle in a directory, in cycle order
+    @staticmethod
+    def load_directory(directory):
+
+        return [GridSearchArchive(filepath) for filepath in sorted(Path(directory).glob('cycle_*.npz'))]
+
+
+# Views of the shared datasets already attached in this process, keyed by their shared memory block names
+_attached_shared_datasets = {}
+
+
+# A dataset of NumPy arrays copied once into shared memory blocks. The creating process and every worker process it is pickled
+# to get read-only, zero-copy views of the same memory (workers attach on first use and keep the views for later tasks).
+class SharedDataset:
+
+    def __init__(self, data):
+
+        # The data is either a single array or a dict of arrays
+        self.single_array = isinstance(data, np.ndarray)
+        arrays = {'data': data} if self.single_array else data
+
+        self.descriptors = {}
+        shared_memories, views = {}, {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            if array.dtype.hasobject:
+                raise Exception('Dataset array \'{}\' has an object dtype, which cannot be placed in shared memory.'.format(name))
+            shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=shared_memory.buf)
+            view[...] = array
+            view.flags.writeable = False
+            self.descriptors[name] = (shared_memory.name, array.shape, array.dtype.str)
+            shared_memories[name], views[name] = shared_memory, view
+        _attached_shared_datasets[self._key()] = (shared_memories, views)
+
+        # The creating process unlinks the shared memory when this object is released (or at exit)
+        self._finalizer = weakref.finalize(self, SharedDataset._unlink, self._key())
+
+    def _key(self):
+
+        return tuple(descriptor[0] for descriptor in self.descriptors.values())
+
+    def __getstate__(self):
+
+        return {'single_array': self.single_array, 'descriptors': self.descriptors}
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self._finalizer = None
+
+    # The read-only views of the dataset (the single array, or a dict of arrays as loaded)
+    def get_data(self):
+
+        if self._key() not in _attached_shared_datasets:
+            shared_memories, views = {}, {}
+            for name, (shared_memory_name, shape, dtype) in self.descriptors.items():
+                shared_memory = SharedMemory(name=shared_memory_name)
+                view = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared_memory.buf)
+                view.flags.writeable = False
+                shared_memories[name], views[name] = shared_memory, view
+            _attached_shared_datasets[self._key()] = (shared_memories, views)
+        views = _attached_shared_datasets[self._key()][1]
+
+        return views['data'] if self.single_array else views
+
+    def release(self):
+
+        if self._finalizer:
+            self._finalizer()
+
+    @staticmethod
+    def _unlink(key):
+
+        shared_memories, views = _attached_shared_datasets.pop(key, ({}, {}))
+        views.clear()
+        for shared_memory in shared_memories.values():
+            shared_memory.close()
+            shared_memory.unlink()
+
+
+# Coordinator for spreading evaluations over worker processes on this or other machines: an Executor which leases each submitted
+# task to a worker connected over a socket (see run_socket_worker) and sets its Future from the returned result. A task is leased
+# again to another worker if its worker disconnects or has not replied within lease_seconds (the slow worker is then dropped).
+# Pass it to GridSearch.calculate or auto_optimise as the executor; the objective must be importable by the workers, and a
+# dataset_loader can only be used with workers on the same machine (the dataset is in this machine's shared memory).
+# Tasks and results are pickled, so anyone able to connect could run arbitrary code: connections are authenticated by authkey,
+# which is random unless given (workers must be given executor.authkey, e.g. as executor.authkey.hex() on their command line).
+class SocketExecutor(Executor):
+
+    def __init__(self, address = ('localhost', 0), authkey = None, lease_seconds = 600, n_expected_workers = 4, family = None):
+
+        if authkey is None:
+            authkey = os.urandom(32)
+        self._listener = Listener(address, family=family, authkey=authkey)
+        self.address, self.family, self.authkey = self._listener.address, family, authkey
+        self.lease_seconds = lease_seconds
+        self._max_workers = n_expected_workers      # Used by GridSearch.calculate to size the chunks and the number in flight
+
+        self._task_ids = itertools.count()
+        self._task_queue = queue.Queue()             # Ids of the tasks waiting for a worker (None tells worker threads to stop)
+        self._tasks = {}                             # Task id: [future, fn, args, kwargs, started]
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self.n_workers_connected = 0
+        self.n_releases = 0
+
+        self._accept_thread = threading.Thread(target=self._accept_workers, daemon=True)
+        self._accept_thread.start()
+
+    def submit(self, fn, *args, **kwargs):
+
+        if self._shutdown:
+            raise RuntimeError('Cannot submit tasks after shutdown.')
+        future, task_id = Future(), next(self._task_ids)
+        with self._lock:
+            self._tasks[task_id] = [future, fn, args, kwargs, False]
+        self._task_queue.put(task_id)
+
+        return future
+
+    def shutdown(self, wait = True, cancel_futures = False):
+
+        if cancel_futures:
+            with self._lock:
+                for future, *_ in self._tasks.values():
+                    future.cancel()
+        if wait:
+            with self._lock:
+                futures = [task[0] for task in self._tasks.values()]
+            for future in futures:
+                try:
+                    future.exception()
+                except Exception:
+                    pass
+        self._shutdown = True
+        self._task_queue.put(None)
+
+        # Wake the accepting thread with a connection of our own so that it sees the shutdown
+        try:
+            Client(self.address, family=self.family, authkey=self.authkey).close()
+        except OSError:
+            pass
+        self._accept_thread.join()
+        self._listener.close()
+
+    def _accept_workers(self):
+
+        while not self._shutdown:
+            try:
+                conn = self._listener.accept()
+            except Exception:
+                continue
+            if self._shutdown:
+                conn.close()
+                break
+            self.n_workers_connected += 1
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def _serve_worker(self, conn):
+
+        task_id = None
+        try:
+            while True:
+                task_id = self._task_queue.get()
+                if task_id is None:
+                    self._task_queue.put(None)
+                    conn.send(('stop',))
+                    return
+
+                # Skip tasks already finished by another worker after being leased again
+                with self._lock:
+                    task = self._tasks.get(task_id)
+                    if task is None or task[0].done():
+                        continue
+                    if not task[4]:
+                        task[4] = True
+                        if not task[0].set_running_or_notify_cancel():
+                            del self._tasks[task_id]
+                            continue
+                future, fn, args, kwargs, _ = task
+
+                conn.send(('task', task_id, fn, args, kwargs))
+                if not conn.poll(self.lease_seconds):
+                    logging.warning('Worker did not return task {} within {} seconds; leasing it to another worker.'.format(task_id, self.lease_seconds))
+                    self._release(task_id)
+                    task_id = None
+                    return
+                status, _, payload = conn.recv()
+
+                with self._lock:
+                    self._tasks.pop(task_id, None)
+                if not future.done():
+                    if status == 'result':
+                        future.set_result(payload)
+                    else:
+                        future.set_exception(payload)
+                task_id = None
+
+        except (EOFError, OSError):
+            if task_id is not None:
+                logging.warning('Worker disconnected during task {}; leasing it to another worker.'.format(task_id))
+                self._release(task_id)
+        finally:
+            conn.close()
+
+    def _release(self, task_id):
+
+        self.n_releases += 1
+        self._task_queue.put(task_id)
+
+
+# Connects to a SocketExecutor and evaluates the tasks it leases until the executor shuts down or the connection is lost,
+# returning the number of tasks evaluated. Run one per core, e.g. in a process started on each worker machine.
+# The authkey is that of the executor (a hex string is also accepted, see SocketExecutor).
+def run_socket_worker(address, authkey, family = None):
+
+    if isinstance(authkey, str):
+        authkey = bytes.fromhex(authkey)
+
+    conn = Client(address, family=family, authkey=authkey)
+    n_tasks = 0
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'stop':
+                break
+            _, task_id, fn, args, kwargs = message
+            try:
+                reply = ('result', task_id, fn(*args, **kwargs))
+            except Exception as e:
+                reply = ('error', task_id, e)
+            try:
+                conn.send(reply)
+            except pickle.PicklingError:
+                conn.send(('error', task_id, Exception('Unpicklable result or exception from task {}: {}'.format(task_id, repr(reply[2])))))
+            n_tasks += 1
+    except (EOFError, OSError):
+        pass
+    finally:
+        conn.close()
+
+    return n_tasks
+
+
+# Streaming record of the k smallest and k largest results seen so far, each kept in a bounded heap. Ties are broken towards
+# the lower flat index (i.e. the first in C order, as np.where would list them).
+class ExtremaTracker:
+
+    def __init__(self, k = 10):
+
+        self.k = k
+        self.reset()
+
+    def reset(self):
+
+        self._min_heap = []         # Entries (-value, -flat_index), so the root is the worst of the k smallest
+        self._max_heap = []         # Entries (value, -flat_index), so the root is the worst of the k largest
+        self.n_seen = 0
+
+    def update(self, values, flat_indices):
+
+        values, flat_indices = np.asarray(values, dtype=float).reshape(-1), np.asarray(flat_indices).reshape(-1)
+        not_nan = ~np.isnan(values)
+        values, flat_indices = values[not_nan], flat_indices[not_nan]
+        self.n_seen += len(values)
+
+        # Only the k smallest and k largest of a large chunk can enter the heaps
+        if len(values) > 2 * self.k:
+            candidates = np.concatenate([np.argpartition(values, self.k - 1)[:self.k], np.argpartition(values, -self.k)[-self.k:]])
+            values, flat_indices = values[candidates], flat_indices[candidates]
+
+        for value, flat_index in zip(values.tolist(), flat_indices.tolist()):
+            self._push(self._min_heap, (-value, -flat_index))
+            self._push(self._max_heap, (value, -flat_index))
+
+    def _push(self, heap, entry):
+
+        if entry in heap:
+            return
+        if len(heap) < self.k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+
+    # The tracked extrema as (value, flat_index) pairs, best first
+    def top(self, min_max):
+
+        if min_max == 'min':
+            return sorted([(-value, -neg_flat_index) for value, neg_flat_index in self._min_heap])
+        elif min_max == 'max':
+            return [(value, -neg_flat_index) for value, neg_flat_index in sorted(self._max_heap, key=lambda entry: (-entry[0], -entry[1]))]
+        else:
+            raise Exception('ExtremaTracker min_max input must be a string of either \'min\' or \'max\'.')
+
 
 # TODO: make more generic alongside usage with algo
 class GridSearch:
     
-    def __init__(self, parameter_vectors, perc_limit = 0.5):
+    def __init__(self, parameter_vectors, perc_limit = 0.5, objective = trading_objective, parameters_can_be_negative = None, use_memo = True,
+                 checkpoint_directory = None, checkpoint_seconds = 60, batch_objective = False, top_k = 10, dataset_loader = None,
+                 surrogate = None, surrogate_margin = 2.0, surrogate_max_points = 2000, verbose = True, objective_id = None,
+                 memo_max_entries = 10**6):
 
         # self.initial_logging()
         self.parameter_vectors = parameter_vectors
         self.parameters = list(parameter_vectors.keys())
-        # self.parameters_can_be_negative = []
+        self.parameters_can_be_negative = parameters_can_be_negative if parameters_can_be_negative else {}
         self.perc_limit = perc_limit
+        self.verbose = verbose      # Whether calculate prints its progress
+
+        # The objective is called as objective(data_file, param_set) and must return a scalar metric
+        # (it must be picklable, e.g. a module level function, to be used with a process pool)
+        self.objective = objective
+        # Name matching the objective's checkpointed results after a restart (by default from _objective_name)
+        self.objective_id = objective_id
+        self.batch_objective = batch_objective       # If True, the objective instead scores whole chunks (see _evaluate_batch)
+
+        # If a dataset_loader is given, it is called once as dataset_loader(data_file) and must return an array or a dict of arrays,
+        # which are placed in shared memory and passed to the objective (as read-only views) in place of data_file
+        self.dataset_loader = dataset_loader
+        self._dataset, self._dataset_file = None, None
+
+        # Optional surrogate ('quadratic', or 'rbf' which needs scipy) fitted to the memoised results once an extremum direction is
+        # known: grid points whose prediction is worse than the best so far by more than surrogate_margin hold-out errors are not
+        # evaluated, but are marked in self.predicted with their predictions in self.predicted_results
+        if surrogate not in [None, 'quadratic', 'rbf']:
+            raise Exception('Unknown surrogate \'{}\', must be None, \'quadratic\' or \'rbf\'.'.format(surrogate))
+        if surrogate and (not use_memo or batch_objective):
+            raise Exception('A surrogate is fitted to the memo, so it cannot be used with use_memo=False or a batch objective.')
+        self.surrogate = surrogate
+        self.surrogate_margin = surrogate_margin
+        self.surrogate_max_points = surrogate_max_points
+        self.surrogate_stats = []   # Points evaluated and predicted (skipped) in each calculate call
+
+        # Memo of already evaluated parameter sets (keyed on the parameter values tuple), which survives across auto_optimise cycles
+        # so that points shared by successive refined grids are looked up rather than recomputed. There is one memo per objective
+        # and data_file (in self.memos), and self.memo is that of the current calculate call. Memos loaded from a checkpoint are
+        # kept by objective name and data_file (in self._checkpoint_memos) until an objective of that name selects them.
+        # Each memo holds at most memo_max_entries points, so that a large full grid does not keep a key tuple per point.
+        self.use_memo = use_memo
+        self.memo_max_entries = memo_max_entries
+        self.memos = {}
+        self.memo = {}
+        self._checkpoint_memos = {}
+        self._memo_checkpoint_contexts = {}
+        self._n_saved_memo_entries = {}     # Number of each memo's (insertion ordered) entries already in the checkpoint
+        self.memo_stats = []        # Hits and misses of each calculate call
+        self.n_evaluations = 0      # Total calls of the objective (per parameter set, also for batch objectives)
+
+        # If a checkpoint directory is given, the results grid and its completion bitmap are memory-mapped .npy files in it, and the
+        # memo and auto_optimise history are saved alongside them, so that a restarted search skips the points already completed.
+        # Memo entries are appended to memo.pkl as they are added, rather than the whole memo being saved each time.
+        self.checkpoint_directory = Path(checkpoint_directory) if checkpoint_directory else None
+        self.checkpoint_seconds = checkpoint_seconds
+        self._checkpoint_state = {}
+        self._last_checkpoint_time = datetime.now()
+        if self.checkpoint_directory:
+            self.checkpoint_directory.mkdir(parents=True, exist_ok=True)
+            if (self.checkpoint_directory / 'state.pkl').exists():
+                with open(str(self.checkpoint_directory / 'state.pkl'), 'rb') as f:
+                    self._checkpoint_state = pickle.load(f)
+            self._load_memo_log()
 
         self.all_indexers = []      # All of the indexers for accessing the results array
+        self.halving_history = []   # Budget, number of candidates and best result of each successive_halving rung
         self.extr_indexers = []     # Results array indices of extrema
         self.min_max = 'None'       # Starts as 'None' to indicate no max or min yet found
 
@@ -22,6 +482,7 @@ class GridSearch:
         self.auto_optimised_extrema_param_sets = []
         self.auto_optimised_extrema = []
         self.auto_optimised_parameter_percent_changes = []
+        self.auto_optimise_stop_reason = None
 
         # Determine which parameters are vectorised for searching over (array with one element is still considered 'vectorised')
         # and check that adequate parameter vectors or equivalence/constant value have been provided for each parameter
@@ -61,8 +522,14 @@ class GridSearch:
                 self.parameter_types[parameter] = type(this_vec[0])
 
 
-        # Initialise empty results array
+        # The top_k smallest and largest results, updated as they are calculated
+        self.extrema_tracker = ExtremaTracker(top_k)
+
+        # Initialise empty results array and its completion bitmap
         self.results = np.array([])
+        self.completed = np.array([], dtype=bool)
+        self._grid_context = None   # The objective and data_file the grid's completed points were calculated for
+        self._grid_checkpoint_context = None    # Their objective name and data_file (all that is known of a reopened grid)
         self.generate_empty_results_array()
 
 
@@ -82,52 +549,471 @@ class GridSearch:
         for parameter in self.parameters:
             if parameter in self.vectorised_parameters:
                 search_shape.append(len(self.parameter_vectors[parameter]))
-        self.results = np.zeros(search_shape)
+        search_shape = tuple(search_shape)
+        self.extrema_tracker.reset()
+        self._grid_context, self._grid_checkpoint_context = None, None
+        if self.surrogate:
+            self.predicted = np.zeros(search_shape, dtype=bool)
+            self.predicted_results = np.full(search_shape, np.nan)
+
+        if not self.checkpoint_directory:
+            # Points not (yet) evaluated are NaN, so that sampled searches can report extrema over a partially evaluated grid
+            self.results = np.full(search_shape, np.nan)
+            self.completed = np.zeros(search_shape, dtype=bool)
+            return
+
+        # Each grid's files are named by a digest of its parameter vectors, so a checkpointed grid is reopened whenever the same
+        # vectors come round again (e.g. on a restart) and is otherwise left alone
+        grid_id = self._parameter_vectors_digest(self.parameter_vectors)
+        self._grid_id = grid_id
+        results_path = str(self.checkpoint_directory / 'results_{}.npy'.format(grid_id))
+        completed_path = str(self.checkpoint_directory / 'completed_{}.npy'.format(grid_id))
+        if Path(results_path).exists() and Path(completed_path).exists():
+            self.results = np.lib.format.open_memmap(results_path, mode='r+')
+            self.completed = np.lib.format.open_memmap(completed_path, mode='r+')
+            if self.results.shape == search_shape and self.completed.shape == search_shape:
+                # The objective and data_file the grid was calculated for (checked by calculate before any points are reused)
+                self._grid_checkpoint_context = self._checkpoint_state.get('grid_contexts', {}).get(grid_id, ('unknown',))
+                logging.info('Resuming checkpointed grid with {}/{} points completed.'.format(int(np.count_nonzero(self.completed)), self.completed.size))
+                # Seed the extrema tracker with the points completed before the restart
+                flat_results, flat_completed = self.results.reshape(-1), self.completed.reshape(-1)
+                for start in range(0, self.results.size, 10**6):
+                    completed = np.flatnonzero(flat_completed[start:start + 10**6]) + start
+                    self.extrema_tracker.update(flat_results[completed], completed)
+                return
+        self.results = np.lib.format.open_memmap(results_path, mode='w+', dtype=float, shape=search_shape)
+        self.results[...] = np.nan
+        self.completed = np.lib.format.open_memmap(completed_path, mode='w+', dtype=bool, shape=search_shape)
+
+    # Reads the checkpointed memo entries, which memo.pkl holds as (objective name and data_file, entries) records, into
+    # self._checkpoint_memos. A record cut short by an interrupted save is truncated, so that later records can follow it.
+    def _load_memo_log(self):
+
+        memo_log_path = self.checkpoint_directory / 'memo.pkl'
+        # Checkpoints from before the memo log kept whole memos in the state
+        for checkpoint_context, memo in self._checkpoint_state.pop('memos', {}).items():
+            self._checkpoint_memos.setdefault(checkpoint_context, {}).update(memo)
+            with open(str(memo_log_path), 'ab') as f:
+                pickle.dump((checkpoint_context, list(memo.items())), f)
+        if not memo_log_path.exists():
+            return
+
+        with open(str(memo_log_path), 'rb') as f:
+            log_end = 0
+            while True:
+                try:
+                    checkpoint_context, entries = pickle.load(f)
+                except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+                    break
+                self._checkpoint_memos.setdefault(checkpoint_context, {}).update(entries)
+                log_end = f.tell()
+            truncate = log_end < os.fstat(f.fileno()).st_size
+        if truncate:
+            with open(str(memo_log_path), 'r+b') as f:
+                f.truncate(log_end)
+
+    # Flushes the memory-mapped grid, appends the memo entries added since the last save to memo.pkl and saves the
+    # auto_optimise history (written to a temporary file first, so that an interrupted save cannot corrupt the previous checkpoint)
+    def save_checkpoint(self):
+
+        if not self.checkpoint_directory:
+            return
+        self.results.flush()
+        self.completed.flush()
+        with open(str(self.checkpoint_directory / 'memo.pkl'), 'ab') as f:
+            for context, memo in self.memos.items():
+                n_saved = self._n_saved_memo_entries[context]
+                if len(memo) > n_saved:
+                    pickle.dump((self._memo_checkpoint_contexts[context], list(itertools.islice(memo.items(), n_saved, None))), f)
+                    self._n_saved_memo_entries[context] = len(memo)
+        self._checkpoint_state.setdefault('grid_contexts', {})[self._grid_id] = self._grid_checkpoint_context
+        state_path = self.checkpoint_directory / 'state.pkl'
+        with open(str(state_path) + '.tmp', 'wb') as f:
+            pickle.dump(self._checkpoint_state, f)
+        os.replace(str(state_path) + '.tmp', str(state_path))
+        self._last_checkpoint_time = datetime.now()
+
+    def _checkpoint_if_due(self):
+
+        if self.checkpoint_directory and (datetime.now() - self._last_checkpoint_time).total_seconds() >= self.checkpoint_seconds:
+            self.save_checkpoint()
+
+    @staticmethod
+    def _parameter_vectors_digest(parameter_vectors):
+
+        canonical = [(parameter, np.asarray(vec).tolist() if isinstance(vec, (list, np.ndarray)) else vec)
+                     for parameter, vec in parameter_vectors.items()]
+
+        return hashlib.sha1(repr(canonical).encode()).hexdigest()[:16]
+
+    # Evaluates every point of the grid, or only those at flat_indices (positions in the C-ordered flattened results array)
+    # Evaluation stops early (leaving the remaining points NaN and not completed) once the deadline datetime passes or
+    # self.n_evaluations reaches max_evaluations (points submitted to an executor count against it, so it is never exceeded)
+    def calculate(self, data_file, current_cycle = -1, total_cycles = -1, n_workers = 1, executor = None, chunk_size = None, flat_indices = None,
+                  deadline = None, max_evaluations = None):
+
+        # Serial evaluation unless a worker count or an executor (any concurrent.futures.Executor) is given
+        own_executor = executor is None and n_workers > 1
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+        elif executor is not None and n_workers <= 1:
+            n_workers = getattr(executor, '_max_workers', 1)
+        self._select_context(data_file)
+        data = self._get_evaluation_data(data_file, executor is not None)
+
+        # Combos are generated and submitted in contiguous chunks (several per worker so that the load stays balanced),
+        # with a bounded number of chunks in flight so that memory use stays proportional to the chunk size
+        n_total = self.results.size if flat_indices is None else len(flat_indices)
+        if chunk_size is None:
+            chunk_size = max(1, min(10000, n_total // (4 * max(n_workers, 1))))
+        max_in_flight = 2 * max(n_workers, 1)
 
-    def calculate(self, data_file, current_cycle = -1, total_cycles = -1):
-
-        parameter_combos, results_indexers = self.get_complete_parameter_combos()
         start_time = datetime.now()
-        for i, combo in enumerate(parameter_combos):
-            # Generate the parameter dictionary
-            param_set = dict(zip(self.parameters, combo))
+        n_done, n_hits, n_skipped, n_predicted = 0, 0, 0, 0
+        surrogate_model = self._fit_surrogate()
+        futures, n_in_flight = {}, 0
+        try:
+            for indexers in self.iter_indexer_chunks(chunk_size, flat_indices):
+                if self._budget_exhausted(deadline, max_evaluations, n_in_flight):
+                    break
+                allowance = None if max_evaluations is None else max_evaluations - self.n_evaluations - n_in_flight
+
+                # Skip any points already completed (e.g. before a restart from a checkpoint)
+                completed = self.completed[indexers]
+                if completed.any():
+                    n_skipped += int(np.count_nonzero(completed))
+                    n_done += int(np.count_nonzero(completed))
+                    keep = np.flatnonzero(~completed)
+                    indexers = tuple(index[keep] for index in indexers)
+                    if len(keep) == 0:
+                        continue
+
+                # A batch objective scores the whole chunk in one call from its parameter columns (the memo is not used)
+                if self.batch_objective:
+                    eval_indexers, memo_keys = tuple(index[:allowance] for index in indexers), []
+                    evaluate, args = _evaluate_batch, (self.objective, data, self.indexers2columns(eval_indexers), len(eval_indexers[0]))
+
+                # Otherwise look up any combos which have already been evaluated, and collect the rest for evaluation
+                else:
+                    combos = self.indexers2combos(indexers)
+                    to_evaluate, memo_keys = self._apply_memo(indexers, combos)
+                    n_hits += len(combos) - len(to_evaluate)
+                    n_done += len(combos) - len(to_evaluate)
+
+                    # Skip the points which the surrogate predicts cannot beat the best so far
+                    if surrogate_model and to_evaluate:
+                        n_to_evaluate = len(to_evaluate)
+                        to_evaluate, memo_keys = self._apply_surrogate(surrogate_model, indexers, to_evaluate, memo_keys)
+                        n_predicted += n_to_evaluate - len(to_evaluate)
+                        n_done += n_to_evaluate - len(to_evaluate)
+                    # Only evaluate as many points as the evaluation budget allows
+                    to_evaluate, memo_keys = to_evaluate[:allowance], memo_keys[:allowance]
+                    if not to_evaluate:
+                        continue
+                    eval_indexers = tuple(index[to_evaluate] for index in indexers)
+                    param_sets = [dict(zip(self.parameters, combos[i])) for i in to_evaluate]
+                    evaluate, args = _evaluate_param_sets, (self.objective, data, param_sets)
+
+                if executor is None and self.batch_objective:
+                    self._store_results(eval_indexers, memo_keys, evaluate(*args))
+                    n_done += len(eval_indexers[0])
+                    self.n_evaluations += len(eval_indexers[0])
+                    self._report_progress(n_done, n_total, start_time, current_cycle, total_cycles)
+                    self._checkpoint_if_due()
+                elif executor is None:
+                    for j, param_set in enumerate(param_sets):
+                        if self._budget_exhausted(deadline, max_evaluations):
+                            break
+                        # Add the resulting metric to the results array
+                        self._store_results(tuple(index[j:j + 1] for index in eval_indexers), memo_keys[j:j + 1], [self.objective(data, param_set)])
+                        n_done += 1
+                        self.n_evaluations += 1
+                        self._report_progress(n_done, n_total, start_time, current_cycle, total_cycles)
+                        self._checkpoint_if_due()
+                else:
+                    futures[executor.submit(evaluate, *args)] = (eval_indexers, memo_keys)
+                    n_in_flight += len(eval_indexers[0])
+                    while len(futures) >= max_in_flight:
+                        n_collected = self._collect_futures(futures, FIRST_COMPLETED)
+                        n_done += n_collected
+                        n_in_flight -= n_collected
+                        self._report_progress(n_done, n_total, start_time, current_cycle, total_cycles)
+
+            while futures:
+                n_collected = self._collect_futures(futures, FIRST_COMPLETED)
+                n_done += n_collected
+                n_in_flight -= n_collected
+                self._report_progress(n_done, n_total, start_time, current_cycle, total_cycles)
+        finally:
+            if own_executor:
+                executor.shutdown()
+            self.save_checkpoint()
+
+        self.memo_stats.append({'hits': n_hits, 'misses': n_total - n_hits - n_skipped - n_predicted})
+        if self.use_memo:
+            logging.info('GridSearch memo: {} hits, {} misses.'.format(n_hits, n_total - n_hits - n_skipped - n_predicted))
+        if self.surrogate:
+            self.surrogate_stats.append({'evaluated': n_total - n_hits - n_skipped - n_predicted, 'predicted': n_predicted})
+            logging.info('GridSearch surrogate: {} points predicted rather than evaluated.'.format(n_predicted))
 
-            # Perform the current parametrisation of the algorithm
-            trades, liquid_cash_history, ticker_data, BAH_data = sim.test_strategy(data_file, param_set)
-            res = o_a.analyse_trades(trades, liquid_cash_history, ticker_data, param_set, BAH_data)
+        return self.results
 
-            # Add the resulting metric to the results array
-            self.results[tuple(results_indexers[i])] = res['net_profit']
+    # The objective and data_file which results are calculated for (unhashable ones are identified by the objects themselves)
+    def _evaluation_context(self, data_file):
 
-            elapsed = (datetime.now() - start_time).total_seconds() / 60
-            remaining = elapsed / (i + 1) * (len(parameter_combos) - i)
-            if current_cycle == -1:
-                print('Calculating error grid point {}/{}. Time elapsed: {} mins, Predicted remaining time: {} mins'.format(i + 1, len(parameter_combos), elapsed, remaining))
-            else:
-                print('Calculating error grid point {}/{}, cycle {}/{}. Time elapsed this cycle: {} mins, Predicted remaining time this cycle: {} mins'.format(i + 1, len(parameter_combos), current_cycle+1, total_cycles, elapsed, remaining))
+        return _hashable_or_id(self.objective), _hashable_or_id(data_file)
 
-        return self.results
+    # The objective's name (see objective_id) and data_file, which identify checkpointed results across restarts
+    def _checkpoint_context(self, data_file):
 
+        objective_id = self.objective_id if self.objective_id is not None else _objective_name(self.objective)
 
-    def get_global_extremum(self, min_max):
+        return objective_id, _hashable_or_id(data_file)
 
-        # Find the global min or max
-        if min_max == 'min':
-            extr = np.amin(self.results)
-        elif min_max == 'max':
-            extr = np.amax(self.results)
+    # Switches self.memo to that of the current objective and data_file (starting from any memo checkpointed for its name), and
+    # starts the grid afresh if its completed points were calculated for a different objective or data_file (including a
+    # checkpointed grid from another search)
+    def _select_context(self, data_file):
+
+        context, checkpoint_context = self._evaluation_context(data_file), self._checkpoint_context(data_file)
+        if context not in self.memos:
+            self.memos[context] = dict(self._checkpoint_memos.get(checkpoint_context, {}))
+            self._memo_checkpoint_contexts[context] = checkpoint_context
+            self._n_saved_memo_entries[context] = len(self.memos[context])
+        self.memo = self.memos[context]
+
+        if self._grid_context is not None:
+            grid_is_other = self._grid_context != context
         else:
-            raise Exception('get_global_extremum input must be a string of either \'min\' or \'max\'.')
+            grid_is_other = self._grid_checkpoint_context is not None and self._grid_checkpoint_context != checkpoint_context
+        if grid_is_other and self.completed.any():
+            logging.warning('GridSearch grid was calculated for a different objective or data_file, so it is started afresh.')
+            self.results[...] = np.nan
+            self.completed[...] = False
+            self.extrema_tracker.reset()
+            if self.surrogate:
+                self.predicted[...] = False
+                self.predicted_results[...] = np.nan
+        self._grid_context, self._grid_checkpoint_context = context, checkpoint_context
+
+    # Fits the surrogate to the memoised results (the surrogate_max_points nearest the best so far), returning
+    # (predict, lower, scales, best, error) or None if there is no extremum direction yet, too few points or non-numeric parameters.
+    # The error is the RMS error of a fit to 80% of the points when predicting the other 20%.
+    def _fit_surrogate(self):
+
+        n_vectorised = len(self.vectorised_parameters)
+        if not self.surrogate or self.min_max not in ['min', 'max'] or len(self.memo) < max(10, 2 * (n_vectorised + 1) * (n_vectorised + 2) // 2):
+            return None
+        try:
+            X = np.array([key[:n_vectorised] for key in self.memo.keys()], dtype=float)
+            y = np.array(list(self.memo.values()), dtype=float)
+        except (TypeError, ValueError):
+            return None
+        finite = np.isfinite(y)
+        X, y = X[finite], y[finite]
+        if len(y) < 10:
+            return None
+
+        # Work in coordinates scaled to the range of the points, keeping those nearest the best so far
+        lower, scales = X.min(axis=0), np.ptp(X, axis=0)
+        scales[scales == 0] = 1
+        X = (X - lower) / scales
+        i_best = np.argmin(y) if self.min_max == 'min' else np.argmax(y)
+        best = y[i_best]
+        if len(y) > self.surrogate_max_points:
+            nearest = np.argsort(np.sum((X - X[i_best])**2, axis=1), kind='stable')[:self.surrogate_max_points]
+            X, y = X[nearest], y[nearest]
+
+        rng = np.random.default_rng(0)
+        holdout = rng.permutation(len(y))[:max(2, len(y) // 5)]
+        train = np.setdiff1d(np.arange(len(y)), holdout)
+        error = np.sqrt(np.mean((self._surrogate_fit(X[train], y[train])(X[holdout]) - y[holdout])**2))
+
+        return self._surrogate_fit(X, y), lower, scales, best, error
+
+    def _surrogate_fit(self, X, y):
+
+        if self.surrogate == 'rbf':
+            try:
+                from scipy.interpolate import RBFInterpolator
+            except ImportError:
+                raise Exception('The \'rbf\' surrogate requires scipy.')
+            return RBFInterpolator(X, y, kernel='thin_plate_spline', smoothing=1e-9)
+
+        # Full quadratic in the vectorised parameters, by least squares
+        def quadratic_features(X):
+            columns = [np.ones(len(X))] + [X[:, i] for i in range(X.shape[1])]
+            columns += [X[:, i] * X[:, j] for i in range(X.shape[1]) for j in range(i, X.shape[1])]
+            return np.stack(columns, axis=1)
+        coefficients = np.linalg.lstsq(quadratic_features(X), y, rcond=None)[0]
+
+        return lambda X_new: quadratic_features(X_new) @ coefficients
+
+    # Marks the points of a chunk which the surrogate predicts cannot beat the best so far, returning the rest to be evaluated
+    def _apply_surrogate(self, surrogate_model, indexers, to_evaluate, memo_keys):
+
+        predict, lower, scales, best, error = surrogate_model
+        eval_indexers = tuple(index[to_evaluate] for index in indexers)
+        columns = self.indexers2columns(eval_indexers)
+        X = (np.stack([np.asarray(columns[parameter], dtype=float) for parameter in self.vectorised_parameters], axis=1) - lower) / scales
+        predictions = predict(X)
+        if self.min_max == 'min':
+            could_beat = predictions - self.surrogate_margin * error <= best
+        else:
+            could_beat = predictions + self.surrogate_margin * error >= best
+
+        skipped = np.flatnonzero(~could_beat)
+        self.predicted[tuple(index[skipped] for index in eval_indexers)] = True
+        self.predicted_results[tuple(index[skipped] for index in eval_indexers)] = predictions[skipped]
+        keep = np.flatnonzero(could_beat)
 
-        # Generate a list of the results indexers pointing to the (possibly non-unique) global extremum
-        self.extr_indexers = []
-        for i, arr in enumerate(np.where(extr == self.results)):
-            if i == 0:
-                for el in arr:
-                    self.extr_indexers.append([el])
+        return [to_evaluate[i] for i in keep], [memo_keys[i] for i in keep]
+
+    # What the objective is given for data_file: data_file itself, or the views of its dataset if there is a dataset_loader
+    # (the dataset is loaded into shared memory on first use and reused until data_file changes or release_dataset is called).
+    # For workers the SharedDataset itself is sent, which pickles to just the names of its shared memory blocks.
+    def _get_evaluation_data(self, data_file, for_workers):
+
+        if self.dataset_loader is None:
+            return data_file
+        if self._dataset is None or self._dataset_file != data_file:
+            self.release_dataset()
+            self._dataset, self._dataset_file = SharedDataset(self.dataset_loader(data_file)), data_file
+
+        return self._dataset if for_workers else self._dataset.get_data()
+
+    def release_dataset(self):
+
+        if self._dataset is not None:
+            self._dataset.release()
+        self._dataset, self._dataset_file = None, None
+
+    # Whether the deadline has passed or max_evaluations have been used, counting n_in_flight evaluations not yet collected
+    def _budget_exhausted(self, deadline, max_evaluations, n_in_flight = 0):
+
+        if deadline is not None and datetime.now() >= deadline:
+            return True
+        if max_evaluations is not None and self.n_evaluations + n_in_flight >= max_evaluations:
+            return True
+
+        return False
+
+    # Waits for some of the in-flight chunks and writes their results (each by its own indexer, so completion order
+    # does not affect the results array). Returns the number of points collected.
+    def _collect_futures(self, futures, return_when):
+
+        n_collected = 0
+        done, _ = wait(futures, return_when=return_when)
+        for future in done:
+            eval_indexers, memo_keys = futures.pop(future)
+            chunk_results = future.result()
+            self._store_results(eval_indexers, memo_keys, chunk_results)
+            n_collected += len(chunk_results)
+        self.n_evaluations += n_collected
+        self._checkpoint_if_due()
+
+        return n_collected
+
+    # Fills the results of any memoised combos in a chunk, returning the positions of the rest and their memo keys
+    def _apply_memo(self, indexers, combos):
+
+        if not self.use_memo:
+            return list(range(len(combos))), [None] * len(combos)
+
+        to_evaluate, memo_keys, hits, hit_results = [], [], [], []
+        for i, combo in enumerate(combos):
+            memo_key = self._memo_key(combo)
+            if memo_key is not None and memo_key in self.memo:
+                hits.append(i)
+                hit_results.append(self.memo[memo_key])
             else:
-                for j, el in enumerate(arr):
-                    self.extr_indexers[j].append(el)
+                to_evaluate.append(i)
+                memo_keys.append(memo_key)
+        if hits:
+            self._store_results(tuple(index[hits] for index in indexers), [], hit_results)
+
+        return to_evaluate, memo_keys
+
+    def _store_results(self, indexers, memo_keys, chunk_results):
+
+        self.results[indexers] = chunk_results
+        self.completed[indexers] = True
+        self.extrema_tracker.update(chunk_results, np.ravel_multi_index(indexers, self.results.shape))
+        for memo_key, res in zip(memo_keys, chunk_results):
+            if memo_key is not None and len(self.memo) < self.memo_max_entries:
+                self.memo[memo_key] = res
+                if len(self.memo) == self.memo_max_entries:
+                    logging.warning('GridSearch memo is full ({} entries), so further points are not memoised.'.format(self.memo_max_entries))
+
+    # Hashable memo key for a parameter combo (None if one of the values cannot be made hashable)
+    @staticmethod
+    def _memo_key(combo):
+
+        key = []
+        for value in combo:
+            if isinstance(value, np.generic):
+                value = value.item()
+            elif isinstance(value, (list, np.ndarray)):
+                value = tuple(np.asarray(value).tolist())
+            elif isinstance(value, dict):
+                value = tuple(sorted(value.items(), key=str))
+            try:
+                hash(value)
+            except TypeError:
+                return None
+            key.append(value)
+
+        return tuple(key)
+
+    def clear_memo(self):
+
+        self.memos = {}
+        self.memo = {}
+        self._checkpoint_memos = {}
+        self._memo_checkpoint_contexts = {}
+        self._n_saved_memo_entries = {}
+        self.memo_stats = []
+        if self.checkpoint_directory and (self.checkpoint_directory / 'memo.pkl').exists():
+            os.remove(str(self.checkpoint_directory / 'memo.pkl'))
+
+    def _report_progress(self, n_done, n_total, start_time, current_cycle, total_cycles):
+
+        if not self.verbose:
+            return
+        elapsed = (datetime.now() - start_time).total_seconds() / 60
+        remaining = elapsed / n_done * (n_total - n_done)
+        if current_cycle == -1:
+            print('Calculating error grid point {}/{}. Time elapsed: {} mins, Predicted remaining time: {} mins'.format(n_done, n_total, elapsed, remaining))
+        else:
+            print('Calculating error grid point {}/{}, cycle {}/{}. Time elapsed this cycle: {} mins, Predicted remaining time this cycle: {} mins'.format(n_done, n_total, current_cycle+1, total_cycles, elapsed, remaining))
+
+
+    def get_global_extremum(self, min_max):
+
+        if min_max not in ['min', 'max']:
+            raise Exception('get_global_extremum input must be a string of either \'min\' or \'max\'.')
+
+        # The extrema tracker gives the extremum without rescanning the grid, unless every tracked entry ties with it
+        # (in which case there may be further tied positions beyond the k tracked)
+        top = self.extrema_tracker.top(min_max)
+        if top and (len(top) < self.extrema_tracker.k or top[-1][0] != top[0][0]):
+            extr = top[0][0]
+            extr_flat_indices = [flat_index for value, flat_index in top if value == extr]
+            self.extr_indexers = [list(indexer) for indexer in zip(*np.unravel_index(extr_flat_indices, self.results.shape))]
+
+        else:
+            # Find the global min or max
+            extr = np.nanmin(self.results) if min_max == 'min' else np.nanmax(self.results)
+
+            # Generate a list of the results indexers pointing to the (possibly non-unique) global extremum
+            self.extr_indexers = []
+            for i, arr in enumerate(np.where(extr == self.results)):
+                if i == 0:
+                    for el in arr:
+                        self.extr_indexers.append([el])
+                else:
+                    for j, el in enumerate(arr):
+                        self.extr_indexers[j].append(el)
 
         if len(self.extr_indexers) > 1:
             logging.warning('Found multiple positions of the global results extremum.')
@@ -135,31 +1021,232 @@ class GridSearch:
 
         return extr, self.extr_indexers
 
+    # The best result calculated so far and its parameter set (or None, None before any results), e.g. for early stopping or live display
+    def get_best_so_far(self, min_max):
+
+        top = self.extrema_tracker.top(min_max)
+        if not top:
+            return None, None
+        value, flat_index = top[0]
+
+        return value, self.indexers2params([list(np.unravel_index(flat_index, self.results.shape))])[0]
+
+    # The tracked results within tolerance of the best so far, as (value, parameter set) pairs, best first
+    def get_near_extrema(self, min_max, tolerance):
 
-    def auto_optimise(self, BTD, direction, cycles, minmax):
+        top = self.extrema_tracker.top(min_max)
+        near = [(value, flat_index) for value, flat_index in top if abs(value - top[0][0]) <= tolerance]
+
+        return [(value, self.indexers2params([list(np.unravel_index(flat_index, self.results.shape))])[0]) for value, flat_index in near]
+
+    # Evaluates a uniformly random subset of n_samples grid points, then finds the extremum among them
+    def random_search(self, data_file, n_samples, minmax, seed = None, **calculate_kwargs):
+
+        rng = np.random.default_rng(seed)
+        flat_indices = np.sort(rng.choice(self.results.size, size=min(n_samples, self.results.size), replace=False))
+        self.calculate(data_file, flat_indices=flat_indices, **calculate_kwargs)
+
+        return self.get_global_extremum(minmax)
+
+    # Evaluates up to n_samples grid points chosen by Latin hypercube sampling (each parameter's range is split into n_samples
+    # strata, each sampled once), then finds the extremum among them
+    def latin_hypercube_search(self, data_file, n_samples, minmax, seed = None, **calculate_kwargs):
+
+        self.calculate(data_file, flat_indices=self.latin_hypercube_flat_indices(n_samples, seed), **calculate_kwargs)
+
+        return self.get_global_extremum(minmax)
+
+    def latin_hypercube_flat_indices(self, n_samples, seed = None):
+
+        rng = np.random.default_rng(seed)
+        indexers = []
+        for n_points in self.results.shape:
+            strata_positions = (rng.permutation(n_samples) + rng.random(n_samples)) / n_samples
+            indexers.append(np.minimum((strata_positions * n_points).astype(int), n_points - 1))
+
+        # Axes with fewer points than samples give repeated points, which are only evaluated once
+        return np.unique(np.ravel_multi_index(tuple(indexers), self.results.shape))
+
+    # Successive halving: evaluates n_samples random grid points at min_budget fidelity, keeps the best 1/eta of them, and repeats
+    # with eta times the budget until max_budget is reached. The budget is passed to the objective as param_set[budget_parameter]
+    # (or columns[budget_parameter] for a batch objective). Only the final, max_budget results are written to self.results.
+    def successive_halving(self, data_file, n_samples, minmax, min_budget, max_budget, eta = 3, budget_parameter = 'budget', seed = None,
+                           n_workers = 1, executor = None):
+
+        if minmax not in ['min', 'max']:
+            raise Exception('successive_halving minmax input must be a string of either \'min\' or \'max\'.')
+        if eta < 2:
+            raise Exception('successive_halving eta must be at least 2.')
+
+        self._select_context(data_file)
+        rng = np.random.default_rng(seed)
+        candidates = np.sort(rng.choice(self.results.size, size=min(n_samples, self.results.size), replace=False))
+        self.halving_history = []
+        budget = min_budget
+        while True:
+            budget = min(budget, max_budget)
+            rung_results = self.evaluate_points(data_file, candidates, {budget_parameter: budget}, n_workers=n_workers, executor=executor)
+            best = np.nanmin(rung_results) if minmax == 'min' else np.nanmax(rung_results)
+            self.halving_history.append({'budget': budget, 'n_candidates': len(candidates), 'best': best})
+            logging.info('Successive halving: best of {} candidates at budget {} is {}.'.format(len(candidates), budget, best))
+            if budget >= max_budget or len(candidates) == 1:
+                break
+
+            # Keep the best 1/eta of the candidates (a stable sort, so ties go to the lower flat index)
+            order = np.argsort(rung_results if minmax == 'min' else -rung_results, kind='stable')
+            candidates = np.sort(candidates[order[:max(1, len(candidates) // eta)]])
+            budget *= eta
+
+        self._store_results(np.unravel_index(candidates, self.results.shape), [], rung_results)
+
+        return self.get_global_extremum(minmax)
+
+    # Evaluates the grid points at flat_indices with extra_parameters added to each parameter set and returns their results
+    # in order, without writing them to self.results or the memo (e.g. for low fidelity evaluations)
+    def evaluate_points(self, data_file, flat_indices, extra_parameters = None, n_workers = 1, executor = None, chunk_size = 1000):
+
+        own_executor = executor is None and n_workers > 1
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=n_workers)
+        data = self._get_evaluation_data(data_file, executor is not None)
+
+        extra_parameters = extra_parameters if extra_parameters else {}
+        tasks = []
+        for indexers in self.iter_indexer_chunks(chunk_size, flat_indices):
+            if self.batch_objective:
+                columns = self.indexers2columns(indexers)
+                columns.update(extra_parameters)
+                tasks.append((_evaluate_batch, (self.objective, data, columns, len(indexers[0]))))
+            else:
+                param_sets = [dict(dict(zip(self.parameters, combo)), **extra_parameters) for combo in self.indexers2combos(indexers)]
+                tasks.append((_evaluate_param_sets, (self.objective, data, param_sets)))
+
+        try:
+            if executor is None:
+                chunk_results = [evaluate(*args) for evaluate, args in tasks]
+            else:
+                chunk_results = [future.result() for future in [executor.submit(evaluate, *args) for evaluate, args in tasks]]
+        finally:
+            if own_executor:
+                executor.shutdown()
+        self.n_evaluations += len(flat_indices)
+
+        return np.concatenate([np.asarray(res, dtype=float) for res in chunk_results]) if chunk_results else np.array([])
+
+    # Refines the grid around the extremum for up to 'cycles' cycles. Stops early once the extremum changes by less than
+    # convergence_perc percent between consecutive cycles, or once max_seconds of wall-clock time or max_evaluations objective
+    # evaluations have been used (a grid cut short by a budget is still used for the extremum of its cycle, but a cycle with no
+    # completed points is not recorded).
+    # If export_directory is given, each cycle's grid is exported to it as cycle_NNN.npz (see export_grid)
+    def auto_optimise(self, BTD, direction, cycles, minmax, convergence_perc = None, max_seconds = None, max_evaluations = None, export_directory = None,
+                      **calculate_kwargs):
 
         self.auto_optimised_vectorisations = []
         self.auto_optimised_extrema_param_sets = []
         self.auto_optimised_extrema = []
         self.auto_optimised_parameter_percent_changes = []
-
-        for cycle in range(cycles):
-
-            # Update the parameter vectorisation and the results grid, unless it is the first cycle
-            if cycle>0:
+        self.auto_optimise_stop_reason = 'completed {} cycles'.format(cycles)
+
+        deadline = datetime.now() + timedelta(seconds=max_seconds) if max_seconds is not None else None
+        if max_evaluations is not None:
+            max_evaluations += self.n_evaluations
+
+        # Resume an interrupted run from its checkpoint (the saved cycle's grid is reopened with its completed points)
+        start_cycle = 0
+        resume = self._checkpoint_state.get('auto_optimise')
+        if resume and 0 < resume['cycle'] < cycles and resume.get('context') != self._checkpoint_context(BTD):
+            logging.warning('Not resuming auto_optimise, as its checkpoint was saved for a different objective or data_file.')
+        elif resume and 0 < resume['cycle'] < cycles:
+            start_cycle = resume['cycle']
+            self.auto_optimised_vectorisations = resume['vectorisations']
+            self.auto_optimised_extrema_param_sets = resume['extrema_param_sets']
+            self.auto_optimised_extrema = resume['extrema']
+            self.auto_optimised_parameter_percent_changes = resume['parameter_percent_changes']
+            self.parameter_vectors = resume['parameter_vectors']
+            self.generate_empty_results_array()
+            logging.info('Resuming auto_optimise from its checkpoint at cycle {}/{}.'.format(start_cycle + 1, cycles))
+
+        for cycle in range(start_cycle, cycles):
+
+            if self._budget_exhausted(deadline, max_evaluations):
+                self.auto_optimise_stop_reason = 'time or evaluation budget used up before cycle {}'.format(cycle + 1)
+                break
+
+            # Update the parameter vectorisation and the results grid, unless it is the first (or resumed) cycle
+            if cycle>start_cycle:
+                if len(self.auto_optimised_extrema_param_sets)>=2:
+                    self.auto_optimised_parameter_percent_changes.append(self.get_parameter_percent_changes())
                 self.parameter_vectors = self.suggest_refined_vectorisation()
                 self.generate_empty_results_array()
-            if len(self.auto_optimised_extrema_param_sets)>=2:
-                self.auto_optimised_parameter_percent_changes.append(self.get_parameter_percent_changes())
+            self._checkpoint_auto_optimise(cycle, BTD)
 
-            # Perform the search over the current grid
-            self.calculate(BTD, direction, current_cycle=cycle, total_cycles=cycles)
+            # Perform the search over the current grid (points already evaluated in earlier cycles come from the memo)
+            self.calculate(BTD, current_cycle=cycle, total_cycles=cycles, deadline=deadline, max_evaluations=max_evaluations, **calculate_kwargs)
+            if not self.completed.any():
+                self.auto_optimise_stop_reason = 'time or evaluation budget used up before any point of cycle {}'.format(cycle + 1)
+                break
 
             # Get the minimum and its index (reject non-uniques)
             the_extr, extr_indexers = self.get_global_extremum(minmax)
             self.auto_optimised_vectorisations.append(self.parameter_vectors)
             self.auto_optimised_extrema_param_sets.append(self.indexers2params(extr_indexers)[0])
             self.auto_optimised_extrema.append(the_extr)
+            if export_directory:
+                Path(export_directory).mkdir(parents=True, exist_ok=True)
+                self.export_grid(Path(export_directory) / 'cycle_{:03d}.npz'.format(cycle), cycle=cycle)
+
+            # Stop refining once the extremum has converged or a budget has been used up
+            if convergence_perc is not None and len(self.auto_optimised_extrema) >= 2:
+                extr_change = abs(self.auto_optimised_extrema[-1] - self.auto_optimised_extrema[-2])
+                if self.auto_optimised_extrema[-2] != 0:
+                    extr_change = extr_change / abs(self.auto_optimised_extrema[-2]) * 100
+                if extr_change < convergence_perc:
+                    self.auto_optimise_stop_reason = 'extremum changed by less than {}% after cycle {}'.format(convergence_perc, cycle + 1)
+                    break
+            if self._budget_exhausted(deadline, max_evaluations):
+                self.auto_optimise_stop_reason = 'time or evaluation budget used up after cycle {}'.format(cycle + 1)
+                break
+
+        logging.info('auto_optimise stopped: {}.'.format(self.auto_optimise_stop_reason))
+
+        # Record that the run finished, so that the next call starts afresh rather than resuming
+        self._checkpoint_auto_optimise(cycles, BTD)
+
+    # Exports the current grid to an .npz file: the results and completion bitmap, a 'vector__<parameter>' array per vectorised
+    # parameter, and a JSON 'metadata' entry with the parameter spec, cycle and extremum (see GridSearchArchive for loading)
+    def export_grid(self, filepath, cycle = None):
+
+        arrays = {'results': np.asarray(self.results), 'completed': np.asarray(self.completed)}
+        for parameter in self.vectorised_parameters:
+            arrays['vector__{}'.format(parameter)] = np.asarray(self.parameter_vectors[parameter])
+
+        metadata = {'parameters': self.parameters,
+                    'vectorised_parameters': self.vectorised_parameters,
+                    'nonvectorised_parameters': {parameter: self.parameter_vectors[parameter] for parameter in self.nonvectorised_parameters},
+                    'cycle': cycle,
+                    'min_max': self.min_max,
+                    'extremum': None,
+                    'extremum_param_set': None,
+                    'n_evaluations': self.n_evaluations,
+                    'export_datetime': datetime.now().isoformat()}
+        if self.min_max in ['min', 'max'] and self.extr_indexers:
+            metadata['extremum'] = self.results[tuple(self.extr_indexers[0])]
+            metadata['extremum_param_set'] = self.indexers2params([self.extr_indexers[0]])[0]
+        arrays['metadata'] = np.array(json.dumps(metadata, default=_json_default))
+
+        np.savez(str(filepath), **arrays)
+
+    def _checkpoint_auto_optimise(self, cycle, data_file):
+
+        if self.checkpoint_directory:
+            self._checkpoint_state['auto_optimise'] = {'cycle': cycle,
+                                                       'context': self._checkpoint_context(data_file),
+                                                       'parameter_vectors': self.parameter_vectors,
+                                                       'vectorisations': list(self.auto_optimised_vectorisations),
+                                                       'extrema_param_sets': list(self.auto_optimised_extrema_param_sets),
+                                                       'extrema': list(self.auto_optimised_extrema),
+                                                       'parameter_percent_changes': list(self.auto_optimised_parameter_percent_changes)}
+            self.save_checkpoint()
 
     def get_parameter_percent_changes(self):
 
@@ -168,7 +1255,11 @@ class GridSearch:
         else:
             perc_changes = {}
             for parameter in self.vectorised_parameters:
-                perc_changes[parameter] =abs((self.auto_optimised_extrema_param_sets[-1][parameter]-self.auto_optimised_extrema_param_sets[2][parameter])/self.auto_optimised_extrema_param_sets[-2][parameter]*100)
+                last, previous = self.auto_optimised_extrema_param_sets[-1][parameter], self.auto_optimised_extrema_param_sets[-2][parameter]
+                if previous == 0:
+                    perc_changes[parameter] = 0 if last == previous else np.inf
+                else:
+                    perc_changes[parameter] =abs((last-previous)/previous*100)
 
         return perc_changes
 
@@ -181,25 +1272,25 @@ class GridSearch:
 
         if len(self.extr_indexers) > 1:
             logging.warning('Non-unique extremum was found - defaulting to the first of these:\n'
-                            '{}'.format(self.indexers2params(extr_indexer)))
+                            '{}'.format(self.indexers2params([extr_indexer])))
 
         # Initialise then populate a dictionary of refined parameter vectors
         refined_parameter_vectors = {}
         for i, parameter in enumerate(self.vectorised_parameters):
 
-            # If the parameter is changing slowly or not at all, can fix its value for subsequent grids
-            if len(self.auto_optimised_parameter_percent_changes)>1 and len(self.parameter_vectors[parameter])>1:
-                if self.auto_optimised_parameter_percent_changes[-1][parameter]<self.perc_limit and self.auto_optimised_parameter_percent_changes[-2][parameter]<self.perc_limit:
-                    logging.info('Parameter \'{}\' changed by less than {}% for two consecutive cycles, so it was fixed after cycle {} of {} total '
-                                 'auto_optimise cycles.'.format(parameter, self.perc_limit, this_cycle-1, total_cycles))
-                    self.paramter_vectors[parameter] = np.array([self.auto_optimised_extrema_param_sets[-1][parameter]])
-
             param_type = self.parameter_types[parameter]
             param_vecs = self.parameter_vectors[parameter]
 
+            # If the parameter is changing slowly or not at all, can fix its value for subsequent grids
+            if len(self.auto_optimised_parameter_percent_changes)>1 and len(param_vecs)>1:
+                if self.auto_optimised_parameter_percent_changes[-1][parameter]<self.perc_limit and self.auto_optimised_parameter_percent_changes[-2][parameter]<self.perc_limit:
+                    logging.info('Parameter \'{}\' changed by less than {}% for two consecutive cycles, so it was fixed after cycle {} of the '
+                                 'auto_optimise cycles.'.format(parameter, self.perc_limit, len(self.auto_optimised_extrema)))
+                    param_vecs = np.array([self.auto_optimised_extrema_param_sets[-1][parameter]])
+
             # If the parameter was specified as a single entry array it will remain unchanged
             if len(param_vecs) == 1:
-                refined_parameter_vectors[parameter] = self.parameter_vectors[parameter]
+                refined_parameter_vectors[parameter] = param_vecs
                 logging.warning('Parameter \'{}\' was specified as a single entry array, so it will remain unchanged.'.format(parameter))
 
             # If the extremum indexer was on a boundary for the current parameter, shift the search space in the direction of the boundary
@@ -226,7 +1317,7 @@ class GridSearch:
                     refined_parameter_vectors[parameter] = refined_parameter_vectors[parameter][np.where(refined_parameter_vectors[parameter]!=0)]
 
                 # Remove any negatives if they are not valid
-                if not self.parameters_can_be_negative[parameter]:
+                if not self.parameters_can_be_negative.get(parameter, True):
                     refined_parameter_vectors[parameter] = refined_parameter_vectors[parameter][np.where(refined_parameter_vectors[parameter]>=0)]
 
                 # Remove any duplicates
@@ -290,23 +1381,13 @@ class GridSearch:
         return indexers
 
 
+    # Materialises every complete parameter combo and its indexer (prefer iter_parameter_combo_chunks for large grids)
     def get_complete_parameter_combos(self):
 
-        # Get the parameter combos excluding the non-vectorised quantities
-        n_vectorised_params = len(self.vectorised_parameters)
-        parameter_combos, indexers = self.get_vectorised_parameter_combos(n_vectorised_params - 1)
-
-        # Add the nonvectorised parameters to the current combo (either a constant or the same as another parameter which was vectorised)
-        for combo in parameter_combos:
-            for parameter in self.nonvectorised_parameters:
-                # If the parameter tracks another vectorised parameter, set it equal to the tracked parameter in this combo
-                if self.parameter_vectors[parameter] in self.vectorised_parameters:
-                    reference_vectorised_parameter = self.parameter_vectors[parameter]
-                    reference_index = self.vectorised_parameters.index(reference_vectorised_parameter)
-                    combo.append(combo[reference_index])
-                # If the parameter is a constant, simply add that constant
-                else:
-                    combo.append(self.parameter_vectors[parameter])
+        parameter_combos, indexers = [], []
+        for chunk_indexers, chunk_combos in self.iter_parameter_combo_chunks():
+            parameter_combos.extend(chunk_combos)
+            indexers.extend([list(indexer) for indexer in zip(*chunk_indexers)])
 
         # Confirm that the number of parameter combos is the same as the number of results entries
         if len(parameter_combos) != self.results.size:
@@ -317,22 +1398,48 @@ class GridSearch:
         return parameter_combos, indexers
 
 
-    def get_vectorised_parameter_combos(self, i_param):
+    # Lazily yields the indexers of consecutive chunks of the (C-ordered) flattened results array, as a tuple with an index
+    # array per vectorised parameter (usable directly as self.results[indexers]). Nothing larger than a chunk is ever materialised.
+    def iter_indexer_chunks(self, chunk_size = 10000, flat_indices = None):
 
-        # Get the current parameter to add to the lower dimensional results
-        this_param = self.vectorised_parameters[i_param]
+        if flat_indices is not None:
+            for start in range(0, len(flat_indices), chunk_size):
+                yield np.unravel_index(np.asarray(flat_indices[start:start + chunk_size]), self.results.shape)
+            return
 
-        # Get the lower dimensional results
-        if i_param == 0:
-            lower_combo_list, lower_indexer_list = [[]], [[]]
-        else:
-            lower_combo_list, lower_indexer_list = self.get_vectorised_parameter_combos(i_param - 1)
+        for start in range(0, self.results.size, chunk_size):
+            yield np.unravel_index(np.arange(start, min(start + chunk_size, self.results.size)), self.results.shape)
+
+
+    # As iter_indexer_chunks, but yields (indexers, combos) where combos are the complete parameter combos of the chunk
+    def iter_parameter_combo_chunks(self, chunk_size = 10000):
+
+        for indexers in self.iter_indexer_chunks(chunk_size):
+            yield indexers, self.indexers2combos(indexers)
+
+
+    # Parameter values for a chunk of indexers: an array per vectorised (or tracking) parameter, and the value itself for constants
+    def indexers2columns(self, indexers):
+
+        columns = {}
+        for parameter, index in zip(self.vectorised_parameters, indexers):
+            columns[parameter] = np.asarray(self.parameter_vectors[parameter])[index]
+        for parameter in self.nonvectorised_parameters:
+            # If the parameter tracks another vectorised parameter, it takes the same values as the tracked parameter
+            if self.parameter_vectors[parameter] in self.vectorised_parameters:
+                columns[parameter] = columns[self.parameter_vectors[parameter]]
+            # If the parameter is a constant, simply use that constant
+            else:
+                columns[parameter] = self.parameter_vectors[parameter]
+
+        return columns
+
+
+    def indexers2combos(self, indexers):
 
-        # Generate the new combo list
-        new_combo_list, new_indexer_list = [], []
-        for c, combo in enumerate(lower_combo_list):
-            for index, value in enumerate(self.parameter_vectors[this_param]):
-                new_combo_list.append(combo + [value])
-                new_indexer_list.append(lower_indexer_list[c] + [index])
+        columns = self.indexers2columns(indexers)
+        n_combos = len(indexers[0]) if indexers else 1
+        combo_columns = [columns[parameter] if parameter in self.vectorised_parameters or self.parameter_vectors[parameter] in self.vectorised_parameters
+                         else [columns[parameter]] * n_combos for parameter in self.parameters]
 
-        return new_combo_list, new_indexer_list
\ No newline at end of file
+        return [list(combo) for combo in zip(*combo_columns)]
@@ -0,0 +1,121 @@
+import json, time, tracemalloc, platform
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+from nicpy.GridSearch import GridSearch
+
+
+# Synthetic objectives of controllable cost (module level so that they can be sent to worker processes)
+
+# Cheap analytic objective: the Rosenbrock function summed over consecutive parameter pairs
+def rosenbrock_objective(data_file, param_set):
+    x = [param_set[parameter] for parameter in sorted(param_set) if parameter.startswith('x')]
+    return sum(100 * (x[i + 1] - x[i]**2)**2 + (1 - x[i])**2 for i in range(len(x) - 1))
+
+# Batch version of rosenbrock_objective, for batch_objective=True
+def rosenbrock_batch_objective(data_file, columns):
+    x = [np.asarray(columns[parameter], dtype=float) for parameter in sorted(columns) if parameter.startswith('x')]
+    return sum(100 * (x[i + 1] - x[i]**2)**2 + (1 - x[i])**2 for i in range(len(x) - 1))
+
+# I/O-bound objective: waits for param_set['cost'] seconds (e.g. a remote call) then scores as rosenbrock_objective
+def sleep_objective(data_file, param_set):
+    time.sleep(param_set['cost'])
+    return rosenbrock_objective(data_file, param_set)
+
+# CPU-bound objective: a pure Python loop of param_set['cost'] iterations then scores as rosenbrock_objective
+def cpu_objective(data_file, param_set):
+    total = 0
+    for i in range(int(param_set['cost'])):
+        total += i % 7
+    return rosenbrock_objective(data_file, param_set) + total * 0
+
+
+def get_parameter_vectors(n_parameters, points_per_axis, cost = None):
+    parameter_vectors = {'x{}'.format(i): np.linspace(-2, 2, points_per_axis) for i in range(n_parameters)}
+    if cost is not None:
+        parameter_vectors['cost'] = cost
+    return parameter_vectors
+
+
+# Times a call, also recording the peak memory allocated during it (tracemalloc slows the call, so it is timed separately)
+def measure(func, repeats = 3):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'best_seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_bytes': peak_bytes}
+
+
+def benchmark_combo_generation(n_parameters, points_per_axis, chunk_size = 10000):
+    gs = GridSearch(get_parameter_vectors(n_parameters, points_per_axis), objective=rosenbrock_objective, verbose=False)
+    def generate():
+        for _ in gs.iter_parameter_combo_chunks(chunk_size):
+            pass
+    result = measure(generate)
+    result['points_per_second'] = gs.results.size / result['best_seconds']
+    return result
+
+
+def benchmark_calculate(objective, n_parameters, points_per_axis, cost = None, n_workers = 1, batch_objective = False, repeats = 1):
+    parameter_vectors = get_parameter_vectors(n_parameters, points_per_axis, cost)
+    def calculate():
+        GridSearch(parameter_vectors, objective=objective, batch_objective=batch_objective, use_memo=False, verbose=False).calculate(None, n_workers=n_workers)
+    result = measure(calculate, repeats)
+    result['points_per_second'] = points_per_axis**n_parameters / result['best_seconds']
+    return result
+
+
+def benchmark_get_global_extremum(n_parameters, points_per_axis, top_k = 10):
+    gs = GridSearch(get_parameter_vectors(n_parameters, points_per_axis), objective=rosenbrock_batch_objective, batch_objective=True,
+                    top_k=top_k, verbose=False)
+    gs.calculate(None)
+    result = {'tracked': measure(lambda: gs.get_global_extremum('min'))}
+
+    # The same lookup with an empty tracker, which falls back to scanning the whole grid
+    gs.extrema_tracker.reset()
+    result['full_scan'] = measure(lambda: gs.get_global_extremum('min'))
+    return result
+
+
+# Runs the benchmark suite, returning its results as a JSON-serialisable dict (and writing it to output_filepath if given)
+def run_benchmarks(output_filepath = None, quick = False):
+
+    grid_sizes = [(2, 50), (4, 12), (6, 6)] if quick else [(2, 300), (4, 30), (6, 12)]
+    results = {'datetime': datetime.now().isoformat(), 'python': platform.python_version(), 'numpy': np.__version__,
+               'platform': platform.platform(), 'benchmarks': []}
+
+    def record(name, parameters, result):
+        results['benchmarks'].append(dict({'name': name}, **parameters, **result))
+        print('{} {}: {}'.format(name, parameters, result))
+
+    for n_parameters, points_per_axis in grid_sizes:
+        grid = {'n_parameters': n_parameters, 'points_per_axis': points_per_axis, 'n_points': points_per_axis**n_parameters}
+        record('combo_generation', grid, benchmark_combo_generation(n_parameters, points_per_axis))
+        record('calculate_cheap_serial', grid, benchmark_calculate(rosenbrock_objective, n_parameters, points_per_axis))
+        record('calculate_cheap_batch', grid, benchmark_calculate(rosenbrock_batch_objective, n_parameters, points_per_axis, batch_objective=True))
+        extremum = benchmark_get_global_extremum(n_parameters, points_per_axis)
+        record('get_global_extremum_tracked', grid, extremum['tracked'])
+        record('get_global_extremum_full_scan', grid, extremum['full_scan'])
+
+    # Serial vs parallel throughput for expensive objectives, on a small grid
+    n_parameters, points_per_axis = 2, 6 if quick else 10
+    for name, objective, cost in [('sleep', sleep_objective, 0.01), ('cpu', cpu_objective, 2 * 10**5)]:
+        for n_workers in [1, 2, 4]:
+            grid = {'n_parameters': n_parameters, 'points_per_axis': points_per_axis, 'n_points': points_per_axis**n_parameters,
+                    'cost': cost, 'n_workers': n_workers}
+            record('calculate_{}'.format(name), grid, benchmark_calculate(objective, n_parameters, points_per_axis, cost, n_workers))
+
+    if output_filepath:
+        with open(str(output_filepath), 'w') as f:
+            json.dump(results, f, indent=2)
+
+    return results
+
+
+if __name__ == '__main__':
+    run_benchmarks(Path.cwd() / 'GridSearch_benchmark_{}.json'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
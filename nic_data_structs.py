@@ -1,41 +1,286 @@
-from datetime import datetime
-from inspect import signature
+from datetime import datetime, date
+from inspect import signature, iscoroutinefunction, Parameter
+from functools import wraps
+from importlib import import_module
+from importlib.util import find_spec
 from pathlib import Path
-import pickle, heapq, numbers
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import pickle, heapq, numbers, os, threading, asyncio, hashlib, uuid, time, io, itertools
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+    fcntl = None
 import numpy as np
 import pandas as pd
 
 
+# Persist directory of the caches kept by this package's own functions (e.g. nic_webscrape's country codes)
+PACKAGE_CACHE_DIRECTORY = Path.home() / '.nicpy_cache'
+
+_key_primitive_types = (int, float, bool, complex, bytes, type(None), datetime, date)
+# Types whose repr identifies the value and its type, so a flat list or tuple of them can be hashed by its repr in one go
+_repr_hashed_types = {int, float, bool, complex, str, type(None)}
+
+
+# Default CacheDict key normaliser. str arguments are kept as they are and other hashable primitives are tagged with their
+# type (so 1, 1.0, True and '1' are all distinct keys), while containers, arrays and DataFrames are replaced by a stable hash
+def normalise_key(key):
+    return tuple(el if type(el) is str else (type(el), el) if type(el) in _key_primitive_types else ('hash', type(el).__name__, stable_hash(el))
+                 for el in key)
+
+
+# Hash of an object's contents that is the same across processes and runs (unlike hash()), for lists, tuples, dicts,
+# sets, arrays, Series and DataFrames of primitives. Other objects are hashed by their pickle.
+def stable_hash(obj):
+    return _update_stable_hash(hashlib.sha1(), obj).hexdigest()
+
+
+def _update_stable_hash(h, obj):
+    h.update(type(obj).__name__.encode() + b':')
+    if isinstance(obj, str):
+        h.update(obj.encode('utf-8', 'surrogatepass'))
+    elif isinstance(obj, bytes):
+        h.update(obj)
+    elif type(obj) in _key_primitive_types or isinstance(obj, np.generic):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, (list, tuple)) and set(map(type, obj)) <= _repr_hashed_types:
+        h.update(b'repr:' + repr(obj).encode('utf-8', 'surrogatepass'))
+    elif isinstance(obj, (list, tuple)):
+        h.update(str(len(obj)).encode())
+        for el in obj:
+            _update_stable_hash(h, el)
+    elif isinstance(obj, (dict, set, frozenset)):
+        # Unordered, so the item hashes are sorted
+        items = obj.items() if isinstance(obj, dict) else obj
+        for item_hash in sorted(stable_hash(item) for item in items):
+            h.update(item_hash.encode())
+    elif isinstance(obj, np.ndarray):
+        h.update('{}{}'.format(obj.dtype, obj.shape).encode())
+        if obj.dtype.hasobject:
+            _update_stable_hash(h, obj.tolist())
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        _update_stable_hash(h, list(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name)
+        h.update(str(list(obj.dtypes) if isinstance(obj, pd.DataFrame) else obj.dtype).encode())
+        h.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+    else:
+        h.update(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+    h.update(b';')
+    return h
+
+
+# Context manager holding an exclusive advisory lock on lock_filepath (created if needed), blocking until it is acquired
+@contextmanager
+def file_lock(lock_filepath):
+    with open(str(lock_filepath), 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            # msvcrt locks a byte range and its blocking mode gives up after 10 seconds, so keep retrying
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+# Calls func with a key holding a value for each of its parameters (in order, with *args as a tuple and **kwargs as a dict)
+def call_with_key(func, key):
+    args, kwargs = [], {}
+    for parameter, value in zip(signature(func).parameters.values(), key):
+        if parameter.kind == Parameter.VAR_POSITIONAL:
+            args.extend(value)
+        elif parameter.kind == Parameter.KEYWORD_ONLY:
+            kwargs[parameter.name] = value
+        elif parameter.kind == Parameter.VAR_KEYWORD:
+            kwargs.update(value)
+        else:
+            args.append(value)
+    return func(*args, **kwargs)
+
+
+# Calls func with a CacheDict key, returning the value and the seconds taken (module level so it can run in worker processes)
+def timed_call(func, key, key_is_args=True):
+    start = time.perf_counter()
+    value = func(*key) if key_is_args else call_with_key(func, key)
+    return value, time.perf_counter() - start
+
+
+# Returns the (compress, decompress) functions of a CacheDict value codec: None, 'gzip', 'zlib', 'lzma', or if their
+# packages are installed 'zstd' (zstandard) or 'lz4'
+def get_codec(codec):
+    if codec is None:
+        return (lambda data: data), (lambda data: data)
+    elif codec in ['gzip', 'zlib', 'lzma']:
+        module = import_module(codec)
+        return module.compress, module.decompress
+    elif codec == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('The zstd codec requires the zstandard package to be installed.')
+        # Compressor objects are not thread-safe, so one is made per call
+        return (lambda data: zstandard.ZstdCompressor().compress(data)), (lambda data: zstandard.ZstdDecompressor().decompress(data))
+    elif codec == 'lz4':
+        try:
+            import lz4.frame
+        except ImportError:
+            raise Exception('The lz4 codec requires the lz4 package to be installed.')
+        return lz4.frame.compress, lz4.frame.decompress
+    raise Exception('Unknown codec \'{}\'; must be None, \'gzip\', \'zlib\', \'lzma\', \'zstd\' or \'lz4\'.'.format(codec))
+
+
+# Encodes a CacheDict value as bytes, returning them with the encoding needed to decode them. DataFrames are written as
+# Parquet if parquet_dataframes (unless Parquet can't hold them, e.g. with non-str column names), other values pickled
+# and compressed by codec.
+def encode_value(value, codec=None, parquet_dataframes=False):
+    if parquet_dataframes and isinstance(value, pd.DataFrame):
+        buffer = io.BytesIO()
+        try:
+            value.to_parquet(buffer)
+            return buffer.getvalue(), ('parquet', None)
+        except Exception:
+            pass
+    return get_codec(codec)[0](pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)), ('pickle', codec)
+
+
+def decode_value(value_bytes, encoding=None):
+    value_format, codec = encoding or ('pickle', None)
+    if value_format == 'parquet':
+        return pd.read_parquet(io.BytesIO(value_bytes))
+    return pickle.loads(get_codec(codec)[1](value_bytes))
+
+
+# Placeholder for a CacheDict value that has not yet been read from the persist file, which is only read from the log
+# (identified by the log_id in its header) that it was indexed in
+class _PersistedValue:
+    __slots__ = ('offset', 'n_bytes', 'log_id')
+
+    def __init__(self, offset, n_bytes, log_id):
+        self.offset, self.n_bytes, self.log_id = offset, n_bytes, log_id
+
+
+# Yields the (operation, key, info, value_offset, n_value_bytes) records of a CacheDict log from the current position of
+# its open file, stopping at the end or at a record cut short (e.g. by a crash during an append)
+def _iter_log_records(f):
+    file_size = os.fstat(f.fileno()).st_size
+    while True:
+        try:
+            operation, key, info, n_value_bytes = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError, ValueError, TypeError):
+            return
+        value_offset = f.tell()
+        if value_offset + n_value_bytes > file_size:
+            return
+        yield operation, key, info, value_offset, n_value_bytes
+        f.seek(value_offset + n_value_bytes)
+
+
+# Caches the results of func by its arguments. If persisted, the cache is stored as an append-only log of pickled
+# (operation, key, info, n_value_bytes) records, each 'set' followed by the pickled value, after a header record.
+# Values are stored pickled and compressed by codec (DataFrames as Parquet if parquet_dataframes), and are only read and
+# decoded from the log on first access. The log is rewritten without superseded records when it
+# grows to more than compaction_ratio times the number of live entries.
+# Thread-safe: concurrent misses on the same key wait on a single call of func, while different keys compute in parallel.
+# If shared, several processes can use the same persist file: appends and compactions hold an advisory lock on a
+# '.lock' file beside it, and records appended by other processes are read before each miss and each write (values
+# are then read eagerly, since another process may compact the log under a lazy value's offset). Instances that are not
+# shared must not write to the same persist file at the same time (their appends may interleave), but a lazy value is
+# only read from the log it was indexed in, so one whose file has been compacted or replaced since is reloaded instead.
+# Entries older than stale_after_hours (but not yet entry_lifetime_hours) are served as they are while being recomputed
+# on a background thread.
 class CacheDict:
 
-    def __init__(self, func, persist_directory=None, persist_filename = None, initial_keys=(), persist_lifetime_hours=10**10):
+    def __init__(self, func, persist_directory=None, persist_filename = None, initial_keys=(), persist_lifetime_hours=10**10,
+                 max_entries=None, max_bytes=None, eviction_policy='lru', entry_lifetime_hours=None, compaction_ratio=2,
+                 key_normaliser=None, shared=False, stale_after_hours=None, codec=None, parquet_dataframes=False):
+
+        if eviction_policy not in ['lru', 'lfu']:
+            raise Exception('eviction_policy must be either \'lru\' (least recently used) or \'lfu\' (least frequently used).')
+
+        # Fail now rather than on the first write if the codec or Parquet engine is unavailable
+        get_codec(codec)
+        if parquet_dataframes and not (find_spec('pyarrow') or find_spec('fastparquet')):
+            raise Exception('Storing DataFrames as Parquet requires pyarrow or fastparquet to be installed.')
 
         self.func = func
         self.func_name = str(func).split(' ')[1]
         self.n_func_args = len(signature(func).parameters)
-        self.cache_dict = {}
+        self.key_normaliser = key_normaliser or normalise_key
+        self.max_entries, self.max_bytes = max_entries, max_bytes
+        self.eviction_policy = eviction_policy
+        self.entry_lifetime_hours = entry_lifetime_hours
+        self.stale_after_hours = stale_after_hours
+        self.compaction_ratio = compaction_ratio
+        self.shared = shared
+        self.codec, self.parquet_dataframes = codec, parquet_dataframes
+        self.cache_dict = OrderedDict()     # Ordered from least to most recently used
+        self.entry_info = {}                # Per-entry save_datetime, n_hits and n_bytes
+        self._lfu_buckets = {}              # For the lfu policy, the keys with each number of hits (least recently used first)
+        self._lfu_min_hits = 0              # The fewest hits of any entry (or a number with no bucket, if it must be looked up)
+        self.n_bytes = 0
+        self.n_hits, self.n_misses, self.n_evictions, self.n_expirations, self.n_refreshes = 0, 0, 0, 0, 0
+        self.compute_seconds, self.compute_seconds_saved, self.persist_seconds = 0., 0., 0.
+        # Keys hold every argument (with defaults applied), so functions with keyword-only or variable arguments are
+        # called by rebuilding their args and kwargs
+        self._key_is_args = all(parameter.kind in [Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD]
+                                for parameter in signature(func).parameters.values())
+        self._pending_records = []          # Records not yet appended to the persist file
+        self._n_log_records = 0
+        self._log_keys = set()              # Keys with a live 'set' record in the persist file
+        self._needs_compaction = False
+        self._log_id, self._log_offset = None, 0   # Identifies the persist file version read, and where its reading stopped
+        self._lock = threading.RLock()      # Guards the entries and serialises persist file access
+        self._in_flight = {}                # Futures of the keys currently being computed
+        self._refresh_executor = None       # Runs the background refreshes of stale entries, created when first needed
 
-        # If the persist_filename exists, load it
+        # If the persist_filename exists, and was saved less than persist_lifetime_hours ago, load it
         self.persist_filepath = None
         if persist_filename and persist_directory:
             self.persist_filepath = Path(persist_directory) / persist_filename
-            if Path(self.persist_filepath).exists():
-
-                persist_load = pickle.load(open(str(self.persist_filepath), 'rb'))
-                persist_CacheDict = persist_load['CacheDict']
-                save_datetime = persist_load['save_datetime']
-                # If the save_datetime is less than persist_lifetime_hours ago, and the func details match, load the old cache_dict
+            if self.persist_filepath.exists():
+                save_datetime = datetime.fromtimestamp(self.persist_filepath.stat().st_mtime)
                 if (datetime.now()-save_datetime).total_seconds()/60/60 < persist_lifetime_hours:
-                    if persist_CacheDict.func == self.func and persist_CacheDict.n_func_args == self.n_func_args and persist_CacheDict.func_name == self.func_name:
-                        self.cache_dict = persist_CacheDict.cache_dict
+                    start = time.perf_counter()
+                    with self._file_lock():
+                        self._load()
+                    self.persist_seconds += time.perf_counter() - start
+                else:
+                    self._needs_compaction = True
 
         if len(initial_keys) > 0:
             for key in initial_keys:
                 self._check_key(key)
-                key_str = tuple(str(el) for el in key)
-                self.cache_dict[key_str] = self.func(*key)
-            if self.persist_filepath:
-                pickle.dump({'CacheDict': self, 'save_datetime': datetime.now()}, open(str(self.persist_filepath), 'wb'))
+                self._set_entry(self.key_normaliser(key), self._call_func(key))
+            self._persist()
+
+    # Locks, futures and executors are not picklable, and belong to this process only
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock'], state['_in_flight'], state['_refresh_executor']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock, self._in_flight, self._refresh_executor = threading.RLock(), {}, None
+
+    def _call_func(self, key):
+        return self.func(*key) if self._key_is_args else call_with_key(self.func, key)
 
     def _check_key(self, key):
         er = 'All keys must be tuples of length equal to number of parameters in the' \
@@ -43,54 +288,759 @@ class CacheDict:
         if not isinstance(key, tuple): raise Exception(er)
         elif len(key) != self.n_func_args: raise Exception(er)
 
+    def _get_header(self):
+        return {'format': 'CacheDict log', 'func_name': self.func_name, 'n_func_args': self.n_func_args,
+                'func_qualname': getattr(self.func, '__qualname__', None),
+                'key_normaliser': getattr(self.key_normaliser, '__qualname__', None)}
+
+    # Holds the advisory lock on the persist file if it is shared between processes
+    def _file_lock(self):
+        if self.shared and self.persist_filepath:
+            if not self.persist_filepath.parent.exists():
+                self.persist_filepath.parent.mkdir()
+            return file_lock(self.persist_filepath.with_name(self.persist_filepath.name + '.lock'))
+        return nullcontext()
+
+    # Reads the persist file's records, leaving values on disk until they are accessed
+    def _load(self):
+        with open(str(self.persist_filepath), 'rb') as f:
+            header = pickle.load(f)
+
+            # Files written as a single pickled CacheDict are loaded whole, then rewritten as a log on the next change. Their
+            # keys were the str of each argument, so only match lookups with those str arguments
+            if 'CacheDict' in header:
+                persist_CacheDict = header['CacheDict']
+                if persist_CacheDict.func == self.func and persist_CacheDict.n_func_args == self.n_func_args and persist_CacheDict.func_name == self.func_name:
+                    for key, value in persist_CacheDict.cache_dict.items():
+                        self._set_entry(self.key_normaliser(key), value, {'save_datetime': header['save_datetime']}, log=False)
+                self._needs_compaction = True
+                return
+
+            if {name: value for name, value in header.items() if name != 'log_id'} != self._get_header():
+                self._needs_compaction = True
+                return
+            self._log_id = header.get('log_id')
+            self._read_records(f)
+
+    # Applies the records from the current position of the open persist file to its end
+    def _read_records(self, f):
+        # A record cut short (e.g. by a crash during an append) ends the log, and is truncated before the next append
+        log_end = f.tell()
+        for operation, key, info, value_offset, n_value_bytes in _iter_log_records(f):
+            if operation == 'set':
+                if self.shared:
+                    self._set_entry(key, decode_value(f.read(n_value_bytes), info.get('encoding')), info, log=False)
+                else:
+                    self._set_entry(key, _PersistedValue(value_offset, n_value_bytes, self._log_id), info, log=False)
+                self._log_keys.add(key)
+            else:
+                self._log_keys.discard(key)
+                if key in self.cache_dict:
+                    self._remove_entry(key, log=False)
+            self._n_log_records += 1
+            log_end = value_offset + n_value_bytes
+        self._log_offset = log_end
+
+        if log_end < os.fstat(f.fileno()).st_size:
+            with open(str(self.persist_filepath), 'r+b') as f:
+                f.truncate(log_end)
+
+    # Reads the records appended to a shared persist file by other processes since it was last read, reloading it whole
+    # if another process has compacted or replaced it (call holding _lock and the file lock)
+    def _sync(self):
+        start = time.perf_counter()
+        try:
+            self._sync_records()
+        finally:
+            self.persist_seconds += time.perf_counter() - start
+
+    def _sync_records(self):
+        if not self.persist_filepath.exists():
+            return
+        with open(str(self.persist_filepath), 'rb') as f:
+            try:
+                log_id = pickle.load(f).get('log_id')
+            except (EOFError, pickle.UnpicklingError, AttributeError):
+                log_id = None
+            if log_id is not None and log_id == self._log_id:
+                f.seek(self._log_offset)
+                self._read_records(f)
+                return
+        self._reload()
+
+    # Reloads the persist file from scratch, after another instance has compacted or replaced it
+    def _reload(self):
+        self.cache_dict.clear()
+        self.entry_info.clear()
+        self._lfu_buckets.clear()
+        self._log_keys.clear()
+        self.n_bytes, self._n_log_records, self._log_id, self._log_offset = 0, 0, None, 0
+        if self.persist_filepath.exists():
+            self._load()
+        # Changes made here but not yet appended are kept
+        for operation, key, info, value_bytes in self._pending_records:
+            if operation == 'set':
+                self._set_entry(key, decode_value(value_bytes, info['encoding']), info, log=False)
+            elif key in self.cache_dict:
+                self._remove_entry(key, log=False)
+
+    # The log_id in the persist file's header (None if the file is missing or is not a log)
+    def _read_log_id(self):
+        try:
+            with open(str(self.persist_filepath), 'rb') as f:
+                return pickle.load(f).get('log_id')
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+            return None
+
+    # Returns the value for a stored key, reading it from the persist file if it has not yet been loaded. If the file is no
+    # longer the log the value was indexed in, it is reloaded first, raising KeyError if the key is then not stored.
+    def _get_value(self, key):
+        value = self.cache_dict[key]
+        if isinstance(value, _PersistedValue):
+            start = time.perf_counter()
+            value_bytes = None
+            # The header and value are read through one handle, so a compaction replacing the file in between can't mix logs
+            try:
+                with open(str(self.persist_filepath), 'rb') as f:
+                    if pickle.load(f).get('log_id') == value.log_id:
+                        f.seek(value.offset)
+                        value_bytes = f.read(value.n_bytes)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError):
+                pass
+            self.persist_seconds += time.perf_counter() - start
+            if value_bytes is None:
+                self._reload()
+                return self._get_value(key)
+            value = decode_value(value_bytes, self.entry_info[key]['encoding'])
+            self.cache_dict[key] = value
+        return value
+
+    # Whether a stored entry is older than entry_lifetime_hours
+    def _is_expired(self, key):
+        if self.entry_lifetime_hours is None:
+            return False
+        return (datetime.now()-self.entry_info[key]['save_datetime']).total_seconds()/60/60 >= self.entry_lifetime_hours
+
+    # Whether a stored entry is older than stale_after_hours, so should be refreshed
+    def _is_stale(self, key):
+        if self.stale_after_hours is None:
+            return False
+        return (datetime.now()-self.entry_info[key]['save_datetime']).total_seconds()/60/60 >= self.stale_after_hours
+
+    # Stores a value with its info (queueing it for persistence if log), then evicts other entries until within max_entries/max_bytes
+    def _set_entry(self, key, value, info=None, log=True):
+        if key in self.cache_dict:
+            self._remove_entry(key, log=False)
+        info = {'save_datetime': datetime.now()} if info is None else info
+        if isinstance(value, _PersistedValue):
+            n_bytes = value.n_bytes
+        elif (log and self.persist_filepath) or self.max_bytes is not None:
+            value_bytes, encoding = encode_value(value, self.codec, self.parquet_dataframes)
+            info = dict(info, encoding=encoding)
+            n_bytes = len(value_bytes)
+            if log and self.persist_filepath:
+                self._pending_records.append(('set', key, info, value_bytes))
+        else:
+            n_bytes = 0
+        self.cache_dict[key] = value
+        self.entry_info[key] = {'save_datetime': info['save_datetime'], 'compute_seconds': info.get('compute_seconds', 0.),
+                                'n_hits': 0, 'n_bytes': n_bytes, 'encoding': info.get('encoding', ('pickle', None))}
+        self.n_bytes += n_bytes
+        if self.eviction_policy == 'lfu':
+            self._lfu_buckets.setdefault(0, OrderedDict())[key] = None
+            self._lfu_min_hits = 0
+        self._evict(keep_key=key)
+
+    def _remove_entry(self, key, log=True):
+        del self.cache_dict[key]
+        info = self.entry_info.pop(key)
+        self.n_bytes -= info['n_bytes']
+        if self.eviction_policy == 'lfu':
+            bucket = self._lfu_buckets[info['n_hits']]
+            del bucket[key]
+            if not bucket:
+                del self._lfu_buckets[info['n_hits']]
+        if log and self.persist_filepath:
+            self._pending_records.append(('delete', key, None, b''))
+
+    # Records a hit on an entry for the eviction policy
+    def _touch(self, key):
+        self.cache_dict.move_to_end(key)
+        self.entry_info[key]['n_hits'] += 1
+        if self.eviction_policy == 'lfu':
+            n_hits = self.entry_info[key]['n_hits']
+            bucket = self._lfu_buckets[n_hits - 1]
+            del bucket[key]
+            if not bucket:
+                del self._lfu_buckets[n_hits - 1]
+                if self._lfu_min_hits == n_hits - 1:
+                    self._lfu_min_hits = n_hits
+            self._lfu_buckets.setdefault(n_hits, OrderedDict())[key] = None
+
+    # Evicts entries by the eviction_policy until the cache is within its limits (never evicting keep_key)
+    def _evict(self, keep_key=None):
+        while len(self.cache_dict) > 1 and ((self.max_entries is not None and len(self.cache_dict) > self.max_entries) or
+                                            (self.max_bytes is not None and self.n_bytes > self.max_bytes)):
+            if self.eviction_policy == 'lru':
+                evict_key = next(key for key in self.cache_dict if key != keep_key)
+            else:
+                evict_key = self._least_frequently_used(keep_key)
+            # Other processes may still want entries evicted from a shared cache, so the eviction is not persisted
+            self._remove_entry(evict_key, log=not self.shared)
+            self.n_evictions += 1
+
+    # The key with the fewest hits (ties going to the least recently used) other than keep_key, from the hit count buckets
+    def _least_frequently_used(self, keep_key):
+        if self._lfu_min_hits not in self._lfu_buckets:
+            self._lfu_min_hits = min(self._lfu_buckets)
+        for key in self._lfu_buckets[self._lfu_min_hits]:
+            if key != keep_key:
+                return key
+        # keep_key is alone in having the fewest hits
+        return next(iter(self._lfu_buckets[min(n_hits for n_hits in self._lfu_buckets if n_hits != self._lfu_min_hits)]))
+
+    # Appends the pending records to the persist file, compacting it instead if it has grown too large
+    def _persist(self):
+        if not self.persist_filepath or not (self._pending_records or self._needs_compaction):
+            return
+        start = time.perf_counter()
+        try:
+            self._append_records()
+        finally:
+            self.persist_seconds += time.perf_counter() - start
+
+    def _append_records(self):
+        # First create the directory if it doesn't yet exist
+        if not self.persist_filepath.parent.exists():
+            self.persist_filepath.parent.mkdir()
+
+        with self._file_lock():
+            if self.shared:
+                self._sync()
+            elif self._read_log_id() != self._log_id:
+                self._reload()
+            n_log_records = self._n_log_records + len(self._pending_records)
+            if self._needs_compaction or n_log_records > self.compaction_ratio * max(len(self._log_keys), len(self.cache_dict), 10):
+                self._compact()
+                return
+
+            with open(str(self.persist_filepath), 'ab') as f:
+                if f.tell() == 0:
+                    self._log_id = uuid.uuid4().hex
+                    pickle.dump(dict(self._get_header(), log_id=self._log_id), f, protocol=pickle.HIGHEST_PROTOCOL)
+                for operation, key, info, value_bytes in self._pending_records:
+                    pickle.dump((operation, key, info, len(value_bytes)), f, protocol=pickle.HIGHEST_PROTOCOL)
+                    f.write(value_bytes)
+                    if operation == 'set':
+                        self._log_keys.add(key)
+                    else:
+                        self._log_keys.discard(key)
+                self._log_offset = f.tell()
+            self._n_log_records = n_log_records
+            self._pending_records = []
+
+    # Rewrites the persist file with one record per live entry
+    def compact(self):
+        if not self.persist_filepath:
+            return
+        with self._lock, self._file_lock():
+            if self.shared:
+                self._sync()
+            elif self._read_log_id() != self._log_id:
+                self._reload()
+            start = time.perf_counter()
+            self._compact()
+            self.persist_seconds += time.perf_counter() - start
+
+    def _compact(self):
+        # A shared cache may hold fewer entries than its log (evictions are not persisted), so its log is compacted from itself
+        if self.shared and not self._needs_compaction and self.persist_filepath.exists():
+            self._compact_log()
+            return
+
+        temp_filepath = self.persist_filepath.with_name(self.persist_filepath.name + '.tmp')
+        new_offsets = {}
+        log_id = uuid.uuid4().hex
+        with open(str(temp_filepath), 'wb') as f:
+            pickle.dump(dict(self._get_header(), log_id=log_id), f, protocol=pickle.HIGHEST_PROTOCOL)
+            for key, value in self.cache_dict.items():
+                if isinstance(value, _PersistedValue):
+                    with open(str(self.persist_filepath), 'rb') as old_f:
+                        old_f.seek(value.offset)
+                        value_bytes = old_f.read(value.n_bytes)
+                else:
+                    value_bytes, self.entry_info[key]['encoding'] = encode_value(value, self.codec, self.parquet_dataframes)
+                info = {name: self.entry_info[key][name] for name in ['save_datetime', 'compute_seconds', 'encoding']}
+                pickle.dump(('set', key, info, len(value_bytes)), f, protocol=pickle.HIGHEST_PROTOCOL)
+                new_offsets[key] = f.tell()
+                f.write(value_bytes)
+            log_offset = f.tell()
+        os.replace(str(temp_filepath), str(self.persist_filepath))
+
+        # Values not yet loaded now live at their new offsets
+        for key, value in self.cache_dict.items():
+            if isinstance(value, _PersistedValue):
+                value.offset, value.log_id = new_offsets[key], log_id
+        self._log_id, self._log_offset = log_id, log_offset
+        self._n_log_records = len(self.cache_dict)
+        self._log_keys = set(self.cache_dict)
+        self._pending_records = []
+        self._needs_compaction = False
+
+    # Rewrites the persist file with one record per key live in it after the pending records, copying the values from the
+    # file itself rather than from the entries in memory (call holding the file lock, after _sync)
+    def _compact_log(self):
+        temp_filepath = self.persist_filepath.with_name(self.persist_filepath.name + '.tmp')
+        log_id = uuid.uuid4().hex
+        with open(str(self.persist_filepath), 'rb') as old_f, open(str(temp_filepath), 'wb') as f:
+            # Each live key's latest info, and its value's offset and size in the old file (or its bytes if pending)
+            live = OrderedDict()
+            pickle.load(old_f)
+            for operation, key, info, value_offset, n_value_bytes in _iter_log_records(old_f):
+                live.pop(key, None)
+                if operation == 'set':
+                    live[key] = (info, value_offset, n_value_bytes, None)
+            for operation, key, info, value_bytes in self._pending_records:
+                live.pop(key, None)
+                if operation == 'set':
+                    live[key] = (info, None, len(value_bytes), value_bytes)
+
+            pickle.dump(dict(self._get_header(), log_id=log_id), f, protocol=pickle.HIGHEST_PROTOCOL)
+            for key, (info, value_offset, n_value_bytes, value_bytes) in live.items():
+                if value_bytes is None:
+                    old_f.seek(value_offset)
+                    value_bytes = old_f.read(n_value_bytes)
+                pickle.dump(('set', key, info, n_value_bytes), f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(value_bytes)
+            log_offset = f.tell()
+        os.replace(str(temp_filepath), str(self.persist_filepath))
+
+        self._log_id, self._log_offset = log_id, log_offset
+        self._n_log_records = len(live)
+        self._log_keys = set(live)
+        self._pending_records = []
+        self._needs_compaction = False
+
     def get_key_value(self, key):
-        self._check_key(key)
-        key_str = tuple(str(el) for el in key)
-        if key_str in self.cache_dict.keys():
-            return self.cache_dict[key_str]
+        return self.get_many([key])[0]
+
+    def _normalise_keys(self, keys):
+        for key in keys:
+            self._check_key(key)
+        return [self.key_normaliser(key) for key in keys]
+
+    # Whether claiming the keys would read the persist file: entries missing, stale or expired here may have been computed
+    # by another process sharing it, and lazily persisted values are loaded from it (call holding _lock)
+    def _claim_reads_file(self, norm_keys):
+        return self._needs_sync(norm_keys) or any(isinstance(self.cache_dict.get(norm_key), _PersistedValue) for norm_key in norm_keys)
+
+    def _needs_sync(self, norm_keys):
+        return self.shared and self.persist_filepath and \
+            any(norm_key not in self.cache_dict.keys() or self._is_stale(norm_key) or self._is_expired(norm_key) for norm_key in norm_keys)
+
+    # Sorts the distinct keys into hits (with their values), keys already being computed elsewhere (with their futures),
+    # and misses that the caller must compute (registered in _in_flight with a new future from create_future)
+    def _claim_keys(self, keys, norm_keys, create_future):
+        values, waiting, owned = {}, {}, {}
+        with self._lock:
+            if self._needs_sync(norm_keys):
+                with self._file_lock():
+                    self._sync()
+            for key, norm_key in zip(keys, norm_keys):
+                if norm_key in values or norm_key in waiting or norm_key in owned:
+                    continue
+                is_hit = norm_key in self.cache_dict.keys() and not self._is_expired(norm_key)
+                if is_hit:
+                    try:
+                        value = self._get_value(norm_key)
+                    except KeyError:
+                        # No longer in the persist file, which another instance has compacted
+                        is_hit = False
+                if is_hit:
+                    self._touch(norm_key)
+                    values[norm_key] = value
+                    self.n_hits += 1
+                    self.compute_seconds_saved += self.entry_info[norm_key]['compute_seconds']
+                    # Stale entries are refreshed in the background (once at a time)
+                    if self._is_stale(norm_key) and norm_key not in self._in_flight:
+                        self._in_flight[norm_key] = create_future()
+                        self.n_refreshes += 1
+                        self._schedule_refresh(key, norm_key, self._in_flight[norm_key])
+                elif norm_key in self._in_flight and not self._in_flight[norm_key].cancelled():
+                    # Counted as a hit, though it saves only part of the compute time
+                    waiting[norm_key] = self._in_flight[norm_key]
+                    self.n_hits += 1
+                else:
+                    self.n_misses += 1
+                    if norm_key in self.cache_dict.keys():
+                        # Expired entries are recomputed
+                        self.n_expirations += 1
+                    owned[norm_key] = (key, create_future())
+                    self._in_flight[norm_key] = owned[norm_key][1]
+        return values, waiting, owned
+
+    # Stores the computed value of a claimed key (unless error is given) and passes the outcome to its waiters
+    def _finish_key(self, norm_key, future, value=None, error=None, compute_seconds=0.):
+        self._store_key(norm_key, value, error, compute_seconds)
+        if error is None:
+            future.set_result(value)
         else:
-            self.cache_dict[key_str] = self.func(*key)
-            # Update the persisted CacheDict if an update occurs
-            if self.persist_filepath:
-                # First create the directory if it doesn't yet exist
-                if not self.persist_filepath.parent.exists():
-                    self.persist_filepath.parent.mkdir()
-                pickle.dump({'CacheDict': self, 'save_datetime': datetime.now()}, open(str(self.persist_filepath), 'wb'))
-            return self.cache_dict[key_str]
+            future.set_exception(error)
+
+    def _store_key(self, norm_key, value=None, error=None, compute_seconds=0.):
+        with self._lock:
+            self.compute_seconds += compute_seconds
+            if error is None:
+                self._set_entry(norm_key, value, {'save_datetime': datetime.now(), 'compute_seconds': compute_seconds})
+            del self._in_flight[norm_key]
+
+    def _schedule_refresh(self, key, norm_key, future):
+        if self._refresh_executor is None:
+            self._refresh_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='CacheDict-refresh')
+        self._refresh_executor.submit(self._refresh, key, norm_key, future)
+
+    # Recomputes a stale entry, which is kept as it is if func fails
+    def _refresh(self, key, norm_key, future):
+        try:
+            value, compute_seconds = timed_call(self.func, key, self._key_is_args)
+        except Exception as e:
+            self._finish_key(norm_key, future, error=e)
+            return
+        self._finish_key(norm_key, future, value, compute_seconds=compute_seconds)
+        self._persist_locked()
+
+    def _persist_locked(self):
+        with self._lock:
+            self._persist()
+
+    # Gets the values for a list of keys, computing the distinct misses on the executor (or serially if None), then
+    # persisting them together
+    def get_many(self, keys, executor=None):
+        norm_keys = self._normalise_keys(keys)
+        values, waiting, owned = self._claim_keys(keys, norm_keys, Future)
+
+        if executor is not None:
+            computations = {norm_key: executor.submit(timed_call, self.func, key, self._key_is_args) for norm_key, (key, _) in owned.items()}
+        errors = []
+        for norm_key, (key, future) in owned.items():
+            try:
+                value, compute_seconds = computations[norm_key].result() if executor is not None else timed_call(self.func, key, self._key_is_args)
+            except BaseException as e:
+                errors.append(e)
+                # Stop computing on interrupts
+                if not isinstance(e, Exception):
+                    break
+                continue
+            self._finish_key(norm_key, future, value, compute_seconds=compute_seconds)
+            values[norm_key] = value
+
+        # Keys that failed (or were not computed due to an interrupt) pass the first error on to any waiting threads
+        for norm_key, (key, future) in owned.items():
+            if not future.done():
+                self._finish_key(norm_key, future, error=errors[0])
+
+        # Update the persisted CacheDict if an update occurs
+        self._persist_locked()
+        if errors:
+            raise errors[0]
+
+        for norm_key, future in waiting.items():
+            values[norm_key] = future.result()
+        return [values[norm_key] for norm_key in norm_keys]
 
     def force_key_value(self, key, value):
         self._check_key(key)
-        if key in self.cache_dict.keys():
-            raise Exception('\'{}\' is already a key in the CacheDict; must explicitly delete it first with delete_key method'.format(key))
-        else:
-            self.cache_dict[key] = value
-            # Update the persisted CacheDict if an update occurs
-            if self.persist_filepath:
-                pickle.dump({'CacheDict': self, 'save_datetime': datetime.now()}, open(str(self.persist_filepath), 'wb'))
+        norm_key = self.key_normaliser(key)
+        with self._lock:
+            if norm_key in self.cache_dict.keys():
+                raise Exception('\'{}\' is already a key in the CacheDict; must explicitly delete it first with delete_key method'.format(key))
+            else:
+                self._set_entry(norm_key, value)
+                # Update the persisted CacheDict if an update occurs
+                self._persist()
 
     def delete_key(self, key):
         self._check_key(key)
-        if key in self.cache_dict.keys():
-            del self.cache_dict[key]
+        norm_key = self.key_normaliser(key)
+        with self._lock:
+            if norm_key in self.cache_dict.keys():
+                self._remove_entry(norm_key)
+                # Update the persisted CacheDict if an update occurs
+                self._persist()
+            else:
+                raise Exception('\'{}\' is not already in the cache.'.format(key))
+
+    # Counts and timings showing how much the cache is saving, as a dict
+    def metrics(self):
+        with self._lock:
+            n_lookups = self.n_hits + self.n_misses
+            return {'func_name': self.func_name, 'n_entries': len(self.cache_dict), 'n_bytes': self.n_bytes,
+                    'n_hits': self.n_hits, 'n_misses': self.n_misses, 'hit_rate': self.n_hits / n_lookups if n_lookups else None,
+                    'n_evictions': self.n_evictions, 'n_expirations': self.n_expirations, 'n_refreshes': self.n_refreshes,
+                    'compute_seconds': self.compute_seconds, 'compute_seconds_saved': self.compute_seconds_saved,
+                    'persist_seconds': self.persist_seconds}
+
+
+# CacheDict for coroutine functions: concurrent awaiters of a key share one in-flight computation, misses in get_many
+# are computed concurrently, and persist file reads (lazily loaded values, shared mode syncs) and writes run in the loop's
+# default executor. Nothing on the loop's thread waits for the lock held by threads using the cache, so in-memory hits are
+# served without leaving the loop unless such a thread holds it.
+class AsyncCacheDict(CacheDict):
+
+    def __init__(self, func, persist_directory=None, persist_filename=None, persist_lifetime_hours=10**10, **kwargs):
+        if not iscoroutinefunction(func):
+            raise Exception('AsyncCacheDict requires a coroutine function, but {} is not one; use CacheDict instead.'.format(func))
+        super().__init__(func, persist_directory, persist_filename, (), persist_lifetime_hours, **kwargs)
+        self._refresh_tasks = set()
+
+    async def get_key_value(self, key):
+        return (await self.get_many([key]))[0]
+
+    # Stale entries are refreshed in a task on the loop of the claiming get_many instead of a thread (started thread-safely
+    # if the keys are claimed in the loop's executor)
+    def _schedule_refresh(self, key, norm_key, future):
+        try:
+            on_loop = asyncio.get_running_loop() is future.get_loop()
+        except RuntimeError:
+            on_loop = False
+        if on_loop:
+            self._start_refresh(key, norm_key, future)
+        else:
+            future.get_loop().call_soon_threadsafe(self._start_refresh, key, norm_key, future)
+
+    def _start_refresh(self, key, norm_key, future):
+        task = future.get_loop().create_task(self._refresh(key, norm_key, future))
+        # The loop only keeps weak references to tasks
+        self._refresh_tasks.add(task)
+        task.add_done_callback(self._refresh_tasks.discard)
+
+    async def _timed_call(self, key):
+        start = time.perf_counter()
+        value = await self._call_func(key)
+        return value, time.perf_counter() - start
+
+    # Calls func (which takes _lock itself) on the loop's thread if _lock is free, otherwise in the loop's executor, so
+    # the loop never blocks on a thread holding _lock. func must not touch the persist file.
+    async def _call_locked(self, func, *args):
+        if self._lock.acquire(blocking=False):
+            try:
+                return func(*args)
+            finally:
+                self._lock.release()
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _refresh(self, key, norm_key, future):
+        try:
+            value, compute_seconds = await self._timed_call(key)
+        except Exception as e:
+            await self._call_locked(self._store_key, norm_key, None, e)
+            future.set_exception(e)
+            # Marks the error as retrieved, since no caller awaits a refresh
+            future.exception()
+            return
+        await self._call_locked(self._store_key, norm_key, value, None, compute_seconds)
+        future.set_result(value)
+        await asyncio.get_running_loop().run_in_executor(None, self._persist_locked)
+
+    # Claims the keys on the loop's thread if _lock is free and the persist file need not be read, otherwise in the loop's
+    # executor (shielded, so that a cancelled caller can still release the keys it claimed)
+    async def _claim_keys_async(self, keys, norm_keys):
+        loop = asyncio.get_running_loop()
+        if self._lock.acquire(blocking=False):
+            try:
+                if not self._claim_reads_file(norm_keys):
+                    return self._claim_keys(keys, norm_keys, loop.create_future)
+            finally:
+                self._lock.release()
+        claim = loop.run_in_executor(None, self._claim_keys, keys, norm_keys, loop.create_future)
+        try:
+            return await asyncio.shield(claim)
+        except asyncio.CancelledError:
+            claim.add_done_callback(lambda claim: claim.exception() is None and self._cancel_claimed(claim.result()[2]))
+            raise
+
+    async def get_many(self, keys):
+        norm_keys = self._normalise_keys(keys)
+        values, waiting, owned = await self._claim_keys_async(keys, norm_keys)
+
+        if owned:
+            try:
+                results = await asyncio.gather(*(self._timed_call(key) for key, _ in owned.values()), return_exceptions=True)
+            except BaseException:
+                self._cancel_claimed(owned)
+                raise
+
+            def store_results():
+                with self._lock:
+                    for norm_key, result in zip(owned, results):
+                        if isinstance(result, BaseException):
+                            self._store_key(norm_key, error=result)
+                        else:
+                            self._store_key(norm_key, result[0], compute_seconds=result[1])
+            await self._call_locked(store_results)
+
+            errors = []
+            for (norm_key, (key, future)), result in zip(owned.items(), results):
+                if isinstance(result, BaseException):
+                    errors.append(result)
+                    future.set_exception(result)
+                    # Marks the error as retrieved, since it is raised to this caller
+                    future.exception()
+                else:
+                    future.set_result(result[0])
+                    values[norm_key] = result[0]
+
             # Update the persisted CacheDict if an update occurs
-            if self.persist_filepath:
-                pickle.dump({'CacheDict': self, 'save_datetime': datetime.now()}, open(str(self.persist_filepath), 'wb'))
+            await asyncio.get_running_loop().run_in_executor(None, self._persist_locked)
+            if errors:
+                raise errors[0]
+
+        # Shielded so that cancelling this awaiter does not cancel the shared computation
+        for norm_key, future in waiting.items():
+            values[norm_key] = await asyncio.shield(future)
+        return [values[norm_key] for norm_key in norm_keys]
+
+    # If cancelled, cancel the waiters of the claimed keys too. Cancelled futures are not waited on by later claims, so
+    # they can be released from _in_flight in the executor if _lock is busy.
+    def _cancel_claimed(self, owned):
+        for norm_key, (key, future) in owned.items():
+            future.cancel()
+        if self._lock.acquire(blocking=False):
+            try:
+                self._release_claimed(owned)
+            finally:
+                self._lock.release()
         else:
-            raise Exception('\'{}\' is not already in the cache.'.format(key))
+            asyncio.get_running_loop().run_in_executor(None, self._release_claimed, owned)
+
+    def _release_claimed(self, owned):
+        with self._lock:
+            for norm_key, (key, future) in owned.items():
+                if self._in_flight.get(norm_key) is future:
+                    del self._in_flight[norm_key]
+
+
+
+# Decorator caching a function in a CacheDict (an AsyncCacheDict for coroutine functions), usable as @cached or with
+# CacheDict arguments as @cached(persist_directory=..., max_entries=...). Calls are keyed on all the bound arguments with
+# defaults applied, so f(1), f(x=1) and f(1, y=2) with default y=2 share an entry. The CacheDict is the wrapper's cache
+# attribute, e.g. for f.cache.metrics().
+def cached(func=None, **cache_kwargs):
+    if func is None:
+        return lambda func: cached(func, **cache_kwargs)
+
+    if cache_kwargs.get('persist_directory') and not cache_kwargs.get('persist_filename'):
+        cache_kwargs['persist_filename'] = '{}.dat'.format(func.__name__)
+    func_signature = signature(func)
+
+    def get_key(args, kwargs):
+        bound_arguments = func_signature.bind(*args, **kwargs)
+        bound_arguments.apply_defaults()
+        return tuple(bound_arguments.arguments.values())
 
+    if iscoroutinefunction(func):
+        cache = AsyncCacheDict(func, **cache_kwargs)
 
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await cache.get_key_value(get_key(args, kwargs))
+    else:
+        cache = CacheDict(func, **cache_kwargs)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return cache.get_key_value(get_key(args, kwargs))
+
+    wrapper.cache = cache
+    return wrapper
+
+# Min-priority queue of hashable items, each queued at most once (putting a queued item changes its priority). Heap entries
+# are [priority, count, item], so that equal priorities come out in insertion order without comparing items. Removed and
+# re-prioritised entries are marked in place and skipped by get (lazy deletion), and the heap is rebuilt when they
+# outnumber the live entries.
 class PriorityQueue:
-    def __init__(self):
-        self.elements = []
+    _removed = object()
+
+    def __init__(self, items_priorities=()):
+        self.elements = []          # Heap of [priority, count, item] entries, including those marked removed
+        self.entry_finder = {}      # Live entry of each queued item
+        self.counter = itertools.count()
+        self.n_removed = 0
+        if items_priorities:
+            self.heapify(items_priorities)
+
+    def __len__(self):
+        return len(self.entry_finder)
+
+    def __contains__(self, item):
+        return item in self.entry_finder
 
     def empty(self):
-        return len(self.elements) == 0
+        return len(self.entry_finder) == 0
+
+    # Adds many (item, priority) pairs with one O(n) heapify rather than n pushes
+    def heapify(self, items_priorities):
+        for item, priority in items_priorities:
+            if item in self.entry_finder:
+                self._mark_removed(item)
+            entry = [priority, next(self.counter), item]
+            self.entry_finder[item] = entry
+            self.elements.append(entry)
+        self._rebuild()
 
     def put(self, item, priority):
-        heapq.heappush(self.elements, (priority, item))
+        if item in self.entry_finder:
+            self._mark_removed(item)
+        entry = [priority, next(self.counter), item]
+        self.entry_finder[item] = entry
+        heapq.heappush(self.elements, entry)
+
+    def update_priority(self, item, priority):
+        if item not in self.entry_finder:
+            raise KeyError('{} is not in the PriorityQueue.'.format(item))
+        self.put(item, priority)
+
+    def remove(self, item):
+        if item not in self.entry_finder:
+            raise KeyError('{} is not in the PriorityQueue.'.format(item))
+        self._mark_removed(item)
+
+    def priority(self, item):
+        return self.entry_finder[item][0]
+
+    # Returns the item with the lowest priority (earliest put among equals) without removing it
+    def peek(self):
+        self._drop_removed()
+        return self.elements[0][2]
 
     def get(self):
-        return heapq.heappop(self.elements)[1]
+        self._drop_removed()
+        item = heapq.heappop(self.elements)[2]
+        del self.entry_finder[item]
+        # Only removed entries can remain
+        if not self.entry_finder:
+            self.elements, self.n_removed = [], 0
+        return item
+
+    # Marks the item's entry removed, rebuilding the heap once removed entries outnumber the live ones (so that it stays
+    # bounded under repeated priority updates as well as removals)
+    def _mark_removed(self, item):
+        self.entry_finder.pop(item)[2] = PriorityQueue._removed
+        self.n_removed += 1
+        if self.n_removed > len(self.entry_finder):
+            self._rebuild()
+
+    def _drop_removed(self):
+        while self.elements and self.elements[0][2] is PriorityQueue._removed:
+            heapq.heappop(self.elements)
+            self.n_removed -= 1
+        if not self.elements:
+            raise IndexError('get from an empty PriorityQueue')
+
+    def _rebuild(self):
+        self.elements = [entry for entry in self.elements if entry[2] is not PriorityQueue._removed]
+        heapq.heapify(self.elements)
+        self.n_removed = 0
 
 
 # Using just the shared columns in two DataFrames, finds full matches. If there are duplicates in the matching columns for each DF,
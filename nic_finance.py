@@ -2,12 +2,16 @@ import yfinance as yf
 import numpy as np
 import pandas as pd
 from pathlib import Path
-from nicpy.nic_data_structs import CacheDict
+from nicpy.nic_data_structs import CacheDict, PACKAGE_CACHE_DIRECTORY
 from nicpy.nic_webscrape import get_check_country_code
 import openpyxl
 from datetime import datetime
 from definitions import ETF_PORTFOLIO_FILEPATH
 
+# Country codes and names for holdings, created once so that its entries are shared between calls and persisted
+_country_code_cache = CacheDict(get_check_country_code, persist_directory=PACKAGE_CACHE_DIRECTORY, persist_filename='read_ETF_holdings.dat',
+                                stale_after_hours=24, entry_lifetime_hours=24*30)
+
 # use
 # "period"
 # instead
@@ -77,7 +81,6 @@ def read_format_ETF_holdings(csv_directory):
     csv_directory = Path(csv_directory)
     holdings = {}
 
-    country_code_cache = CacheDict(get_check_country_code, persist_filename = 'read_ETF_holdings.dat', persist_lifetime_hours=24)
     code_edits = {'UM': 'US'}
 
     # Vanguard - 'VAE', 'VAP', 'VAS', 'VEU', 'VGS', 'VTS'
@@ -90,7 +93,7 @@ def read_format_ETF_holdings(csv_directory):
         holdings[ticker].rename(columns={'% of net assets': 'Weight (%)'}, inplace=True)
         holdings[ticker] = holdings[ticker].applymap(lambda x: format_vanguard(x))
         holdings[ticker] = holdings[ticker][holdings[ticker]['Country code'] != '—']
-        holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: country_code_cache.get_key_value((x, code_edits))[0])
+        holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: _country_code_cache.get_key_value((x, code_edits))[0])
         holdings[ticker] = holdings[ticker].astype({'Weight (%)':float})
         holdings[ticker]['Sector'] = holdings[ticker]['Sector'].apply(lambda x: get_general_sector(x))
 
@@ -102,7 +105,7 @@ def read_format_ETF_holdings(csv_directory):
     holdings[ticker] = holdings[ticker][keep_cols]
     holdings[ticker]['Weight (%)'] = holdings[ticker]['Weight (%)']*100
     holdings[ticker].rename(columns={'Country': 'Country code'}, inplace=True)
-    holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: country_code_cache.get_key_value((x, code_edits))[0])
+    holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: _country_code_cache.get_key_value((x, code_edits))[0])
     holdings[ticker]['Ticker'] = holdings[ticker]['Ticker'].apply(lambda x: x.split(' ')[0])
     # Convert to iShares sectors
     sector_map = {'Communication Services':'Communication', 'Healthcare': 'Health Care'}
@@ -115,7 +118,7 @@ def read_format_ETF_holdings(csv_directory):
     holdings[ticker] = holdings[ticker][keep_cols]
     holdings[ticker].rename(columns={'Location': 'Country code'}, inplace=True)
     holdings[ticker].dropna(how='any', subset=['Weight (%)', 'Sector', 'Country code'], inplace=True)
-    holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: country_code_cache.get_key_value((x, code_edits))[0])
+    holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: _country_code_cache.get_key_value((x, code_edits))[0])
 
     # iShares - IVV
     ticker = 'IVV'
@@ -124,7 +127,7 @@ def read_format_ETF_holdings(csv_directory):
     holdings[ticker] = holdings[ticker][keep_cols]
     holdings[ticker].rename(columns={'Location': 'Country code'}, inplace=True)
     holdings[ticker].dropna(how='any', subset=['Weight (%)', 'Sector', 'Country code'], inplace=True)
-    holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: country_code_cache.get_key_value((x, code_edits))[1])
+    holdings[ticker]['Country code'] = holdings[ticker]['Country code'].apply(lambda x: _country_code_cache.get_key_value((x, code_edits))[1])
 
     return holdings
 
@@ -168,9 +171,8 @@ def export_holdings_sector_country_weights(holdings):
         sector_weights_df.sort_index(inplace=True)
         country_weights_df = pd.DataFrame(country_weights)
         country_weights_df.sort_index(inplace=True)
-        country_code_cache = CacheDict(get_check_country_code, persist_filename='read_ETF_holdings.dat', persist_lifetime_hours=24)
         country_weights_df['Country'] = country_weights_df.index
-        country_weights_df.index = country_weights_df['Country'].apply(lambda x: x+'/'+country_code_cache.get_key_value((x, {}))[1])
+        country_weights_df.index = country_weights_df['Country'].apply(lambda x: x+'/'+_country_code_cache.get_key_value((x, {}))[1])
         country_weights_df.drop(columns=['Country'], inplace=True)
         sector_weights_df.to_excel('sector_weights_python.xlsx')
         country_weights_df.to_excel('country_weights_python.xlsx')
@@ -120,7 +120,7 @@ def distance(distance_type, coords1, coords2):
         return np.sqrt(sum(squares))
     elif distance_type == 'octile':
         dx, dy = abs(coords1[0]-coords2[0]), abs(coords1[1]-coords2[1])
-        return abs(dx-dy) + np.sqrt(2)*min(dx, dy)
+        return abs(dx-dy) + np.sqrt(2)*np.minimum(dx, dy)
     elif distance_type == 'manhattan':
         deltas = [abs(coord1 - coord2) for coord1, coord2 in zip(coords1, coords2)]
         return sum(deltas)
@@ -0,0 +1,264 @@
+import numpy as np
+from nicpy.nic_misc import distance
+from nicpy.nic_data_structs import PriorityQueue
+
+DIAGONAL_COST = 2 ** 0.5
+HEURISTIC_TILE_SIZE = 64
+
+
+def sign(x):
+    return (x > 0) - (x < 0)
+
+
+# A*/Dijkstra shortest paths over an occupancy grid (nonzero/True cells are blocked), with unit cost orthogonal moves and
+# (if diagonal) sqrt(2) cost diagonal moves, which may not cut the corner of a blocked cell unless corner_cutting.
+# The grid is padded with a border of blocked cells and flattened, so neighbours are found by adding precomputed flat
+# offsets with no bounds checks. g-scores, heuristics, parents and open/closed states are kept in arrays allocated by
+# the first search and reused by every later one (read through memoryviews, which index faster than NumPy): states are
+# stamped with a per-search number, so nothing needs resetting between searches. Heuristics are computed with
+# nic_misc.distance vectorised over tiles of HEURISTIC_TILE_SIZE cells square, as the search first reaches each tile.
+class GridPathfinder:
+
+    def __init__(self, occupancy, diagonal=True, corner_cutting=False):
+
+        occupancy = np.asarray(occupancy)
+        if occupancy.ndim != 2:
+            raise Exception('The occupancy grid must be 2D, but has shape {}.'.format(occupancy.shape))
+        self.shape = occupancy.shape
+        self.diagonal, self.corner_cutting = diagonal, corner_cutting
+        self.padded_width = self.shape[1] + 2
+        padded = np.zeros((self.shape[0] + 2, self.padded_width), dtype=np.uint8)
+        padded[1:-1, 1:-1] = occupancy == 0
+        self.passable = bytearray(padded.tobytes())
+        self.passable_array = np.frombuffer(self.passable, dtype=np.uint8)    # Shares memory with passable
+
+        # (flat offset, cost, row offset part, column offset part) of each move, the parts being used to check corners
+        w = self.padded_width
+        self.moves = [(-w, 1., 0, 0), (w, 1., 0, 0), (-1, 1., 0, 0), (1, 1., 0, 0)]
+        if diagonal:
+            self.moves += [(dr * w + dc, DIAGONAL_COST, dr * w, dc) for dr in [-1, 1] for dc in [-1, 1]]
+
+        self.g_scores, self.h_scores, self.parents, self.states = None, None, None, None
+        self.n_tile_cols = -(-self.padded_width // HEURISTIC_TILE_SIZE)
+        self.tile_searches = [0] * (-(-(self.shape[0] + 2) // HEURISTIC_TILE_SIZE) * self.n_tile_cols)
+        self.n_searches = 0
+        self.n_expanded = 0     # Nodes expanded by the last search
+
+    def _allocate_arrays(self):
+        n_cells = len(self.passable)
+        index_dtype = np.int32 if n_cells < 2**31 else np.int64
+        self.g_scores, self.h_scores = memoryview(np.zeros(n_cells)), memoryview(np.zeros(n_cells))
+        self.parents = memoryview(np.zeros(n_cells, dtype=index_dtype))
+        self.states = memoryview(np.zeros(n_cells, dtype=np.int32))     # 2 * search number if open, + 1 if closed
+
+    # Fills in the heuristic of every cell in a tile, as the distance to the nearest of the goals
+    def _fill_heuristic_tile(self, tile, heuristic, goal_coords):
+        tile_row, tile_col = divmod(tile, self.n_tile_cols)
+        row_slice = slice(tile_row * HEURISTIC_TILE_SIZE, min((tile_row + 1) * HEURISTIC_TILE_SIZE, self.shape[0] + 2))
+        col_slice = slice(tile_col * HEURISTIC_TILE_SIZE, min((tile_col + 1) * HEURISTIC_TILE_SIZE, self.padded_width))
+        rows, cols = np.mgrid[row_slice, col_slice]
+        h_scores = np.asarray(self.h_scores).reshape(-1, self.padded_width)
+        h_scores[row_slice, col_slice] = np.min([distance(heuristic, (rows, cols), goal) for goal in goal_coords], axis=0)
+
+    def _to_node(self, cell):
+        row, col = cell
+        if not (0 <= row < self.shape[0] and 0 <= col < self.shape[1]):
+            raise Exception('Cell {} is outside the grid of shape {}.'.format(cell, self.shape))
+        return (row + 1) * self.padded_width + col + 1
+
+    def _to_cell(self, node):
+        row, col = divmod(node, self.padded_width)
+        return row - 1, col - 1
+
+    # Blocks (or unblocks) a list of (row, col) cells
+    def set_blocked(self, cells, blocked=True):
+        for cell in cells:
+            self.passable[self._to_node(cell)] = 0 if blocked else 1
+
+    def is_blocked(self, cell):
+        return not self.passable[self._to_node(cell)]
+
+    def find_path(self, start, goal, heuristic='default', jps=False):
+        return self.find_paths(start, [goal], heuristic, jps)[tuple(goal)]
+
+    # Finds the shortest paths from start to each of goals in one search, returning a dict of goal: (path, cost), each path
+    # an array of (row, col) cells from start to goal, or (None, inf) if the goal is unreachable. heuristic is a
+    # nic_misc.distance type ('euclidian', 'octile' or 'manhattan'), 'default' for octile (or manhattan without diagonal
+    # moves), or None for Dijkstra. manhattan overestimates diagonal moves, so it can only be used without them (otherwise paths
+    # would not be shortest). For multiple goals the heuristic is the distance to the nearest goal. jps uses jump
+    # point search, which expands far fewer nodes on open grids (needs diagonal moves without corner cutting).
+    def find_paths(self, start, goals, heuristic='default', jps=False):
+
+        if heuristic == 'default':
+            heuristic = 'octile' if self.diagonal else 'manhattan'
+        if heuristic == 'manhattan' and self.diagonal:
+            raise Exception('The manhattan heuristic overestimates the cost of diagonal moves, so cannot be used with diagonal=True.')
+        if jps and not (self.diagonal and not self.corner_cutting):
+            raise Exception('Jump point search requires diagonal moves without corner cutting.')
+
+        start_node = self._to_node(start)
+        goal_nodes = {self._to_node(goal): tuple(goal) for goal in goals}
+        goal_coords = [divmod(node, self.padded_width) for node in goal_nodes]
+        self.goal_array = np.array(list(goal_nodes))
+
+        if self.g_scores is None:
+            self._allocate_arrays()
+        self.n_searches += 1
+        search, open_state, closed_state = self.n_searches, 2 * self.n_searches, 2 * self.n_searches + 1
+        passable, g_scores, h_scores, parents, states = self.passable, self.g_scores, self.h_scores, self.parents, self.states
+        w, n_tile_cols, tile_searches = self.padded_width, self.n_tile_cols, self.tile_searches
+        self.n_expanded = 0
+
+        def get_h(node):
+            if heuristic is None:
+                return 0.
+            row, col = divmod(node, w)
+            tile = row // HEURISTIC_TILE_SIZE * n_tile_cols + col // HEURISTIC_TILE_SIZE
+            if tile_searches[tile] != search:
+                self._fill_heuristic_tile(tile, heuristic, goal_coords)
+                tile_searches[tile] = search
+            return h_scores[node]
+
+        queue = PriorityQueue()
+        results = {goal: (None, np.inf) for goal in goal_nodes.values()}
+        n_remaining = len(goal_nodes)
+        if passable[start_node]:
+            g_scores[start_node], parents[start_node], states[start_node] = 0., -1, open_state
+            h = get_h(start_node)
+            queue.put(start_node, (h, h))
+
+        moves, corner_cutting = self.moves, self.corner_cutting
+        while n_remaining and not queue.empty():
+            node = queue.get()
+            states[node] = closed_state
+            self.n_expanded += 1
+            node_g = g_scores[node]
+
+            if node in goal_nodes:
+                results[goal_nodes[node]] = (self._reconstruct_path(node), node_g)
+                n_remaining -= 1
+
+            if jps:
+                successors = self._jump_successors(node, goal_nodes)
+            else:
+                successors = [(node + offset, cost) for offset, cost, row_part, col_part in moves if passable[node + offset] and
+                              (not row_part or corner_cutting or (passable[node + row_part] and passable[node + col_part]))]
+            for neighbour, cost in successors:
+                state = states[neighbour]
+                if state == closed_state:
+                    continue
+                neighbour_g = node_g + cost
+                if state != open_state or neighbour_g < g_scores[neighbour]:
+                    g_scores[neighbour], parents[neighbour], states[neighbour] = neighbour_g, node, open_state
+                    # Ties in f = g + h go to the node nearer a goal
+                    h = get_h(neighbour)
+                    queue.put(neighbour, (neighbour_g + h, h))
+
+        return results
+
+    # Follows parents back from node, filling in the cells between successive jump points
+    def _reconstruct_path(self, node):
+        nodes = [node]
+        while self.parents[node] != -1:
+            parent = self.parents[node]
+            (row, col), (parent_row, parent_col) = divmod(node, self.padded_width), divmod(parent, self.padded_width)
+            n_steps = max(abs(row - parent_row), abs(col - parent_col))
+            step = (row - parent_row) // n_steps * self.padded_width + (col - parent_col) // n_steps
+            nodes.extend(node - step * i for i in range(1, n_steps + 1))
+            node = parent
+        return np.array([self._to_cell(node) for node in reversed(nodes)])
+
+    # Directions worth searching from a node reached from its parent, pruned as in jump point search
+    def _jps_directions(self, node):
+        parent = self.parents[node]
+        w, passable = self.padded_width, self.passable
+        if parent == -1:
+            return [(offset, row_part, col_part) for offset, _, row_part, col_part in self.moves
+                    if not row_part or (passable[node + row_part] and passable[node + col_part])]
+
+        (row, col), (parent_row, parent_col) = divmod(node, w), divmod(parent, w)
+        d_row, d_col = sign(row - parent_row) * w, sign(col - parent_col)
+        directions = []
+        if d_row and d_col:
+            # Diagonal: continue diagonally and along both components
+            if passable[node + d_row]:
+                directions.append((d_row, 0, 0))
+            if passable[node + d_col]:
+                directions.append((d_col, 0, 0))
+            if passable[node + d_row] and passable[node + d_col]:
+                directions.append((d_row + d_col, d_row, d_col))
+        else:
+            # Straight: continue ahead, and turn where a wall behind a side cell forces it
+            ahead = d_row or d_col
+            sides = [1, -1] if d_row else [w, -w]
+            for side in sides:
+                if passable[node + side]:
+                    directions.append((side, 0, 0))
+                    if passable[node + ahead]:
+                        directions.append((ahead + side, ahead if d_row else side, side if d_row else ahead))
+            if passable[node + ahead]:
+                directions.append((ahead, 0, 0))
+        return directions
+
+    def _jump_successors(self, node, goal_nodes):
+        for offset, row_part, col_part in self._jps_directions(node):
+            if row_part:
+                jump_point = self._jump_diagonal(node + offset, row_part, col_part, goal_nodes)
+            else:
+                jump_point = self._jump_straight(node + offset, offset, goal_nodes)
+            if jump_point != -1:
+                (row, col), (jump_row, jump_col) = divmod(node, self.padded_width), divmod(jump_point, self.padded_width)
+                d_row, d_col = abs(jump_row - row), abs(jump_col - col)
+                yield jump_point, abs(d_row - d_col) + DIAGONAL_COST * min(d_row, d_col)
+
+    # Steps from node in a straight direction until reaching a goal or a node with a forced neighbour (returned), or a
+    # blocked cell (returning -1). Short jumps are stepped in Python, and long ones continued with NumPy.
+    def _jump_straight(self, node, offset, goal_nodes):
+        passable = self.passable
+        sides = [self.padded_width, -self.padded_width] if abs(offset) == 1 else [1, -1]
+        for _ in range(16):
+            if not passable[node]:
+                return -1
+            if node in goal_nodes:
+                return node
+            for side in sides:
+                if passable[node + side] and not passable[node - offset + side]:
+                    return node
+            node += offset
+        return self._jump_straight_array(node, offset, sides)
+
+    def _jump_straight_array(self, node, offset, sides):
+        length = self.padded_width if abs(offset) == 1 else self.shape[0] + 2
+
+        def line(start):
+            stop = start + offset * length
+            return self.passable_array[start:stop if stop >= 0 else None:offset]
+
+        # The border guarantees a blocked cell within the line
+        segment = line(node)
+        n_open = int(np.argmin(segment))
+        forced = np.zeros(n_open, dtype=bool)
+        for side in sides:
+            forced |= (line(node + side)[:n_open] != 0) & (line(node - offset + side)[:n_open] == 0)
+        n_steps = int(np.argmax(forced)) if forced.any() else n_open
+
+        # Goals along the line before the forced neighbour or blocked cell
+        goal_steps, remainders = np.divmod(self.goal_array - node, offset)
+        goal_steps = goal_steps[(remainders == 0) & (goal_steps >= 0) & (goal_steps < n_steps)]
+        if len(goal_steps):
+            n_steps = int(goal_steps.min())
+        return node + offset * n_steps if n_steps < n_open else -1
+
+    # Steps from node diagonally until reaching a goal or a node from which a straight jump finds a jump point
+    def _jump_diagonal(self, node, row_part, col_part, goal_nodes):
+        passable = self.passable
+        while passable[node]:
+            if node in goal_nodes:
+                return node
+            if self._jump_straight(node + row_part, row_part, goal_nodes) != -1 or \
+                    self._jump_straight(node + col_part, col_part, goal_nodes) != -1:
+                return node
+            if not (passable[node + row_part] and passable[node + col_part]):
+                return -1
+            node += row_part + col_part
+        return -1
@@ -6,7 +6,7 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as ptc
 import nic_str as ns
 import nic_plot
-from nicpy.nic_data_structs import CacheDict
+from nicpy.nic_data_structs import CacheDict, PACKAGE_CACHE_DIRECTORY
 from pathlib import Path
 
 # Gets weather data for past 5 days as well as
@@ -488,9 +488,8 @@ def get_check_country_code(country_or_code, bespoke_code_edits={}):
     # If the locally saved table has not been downloaded for 24 hours, download it again
     def wikipedia_table2df_weather():
         return wikipedia_table2df('ISO_3166-1_alpha-2', [2])['2']
-    country_code_cache_dict = CacheDict(wikipedia_table2df, persist_filename = 'get_check_country_code.dat', persist_lifetime_hours=24)
     # country_codes_df = wikipedia_table2df('ISO_3166-1_alpha-2', [2])['2']
-    country_codes_df = country_code_cache_dict.get_key_value(('ISO_3166-1_alpha-2',[2],False))['2']
+    country_codes_df = _wikipedia_table_cache.get_key_value(('ISO_3166-1_alpha-2',[2],False))['2']
 
     # Check the table
     expected_cols = ['CODE', 'COUNTRY NAME (USING TITLE CASE)', 'YEAR', 'CCTLD', 'NOTES']
@@ -585,6 +584,10 @@ def wikipedia_table2df(wikipedia_URL, table_indices = 'all', can_clip_data = Fal
 
     return dfs
 
+# Wikipedia tables for get_check_country_code, created once so that its entries are shared between calls and persisted
+_wikipedia_table_cache = CacheDict(wikipedia_table2df, persist_directory=PACKAGE_CACHE_DIRECTORY, persist_filename='get_check_country_code.dat',
+                                   stale_after_hours=24, entry_lifetime_hours=24*30)
+
 def timestamps_are_same_day_in_local_time(ts1, ts2, utc_time_delta):
 
     if isinstance(ts1, int): ts1 = datetime.utcfromtimestamp(ts1) + utc_time_delta
@@ -0,0 +1,450 @@
+import pytest, threading
+import numpy as np
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from nicpy.GridSearch import GridSearch, GridSearchArchive, SocketExecutor, run_socket_worker
+
+
+def quadratic_objective(data_file, param_set):
+    return (param_set['x'] - 1.2)**2 + (param_set['y'] + 0.4)**2 + param_set['offset']
+
+
+def get_test_grid_search(**kwargs):
+    parameter_vectors = {'x': np.linspace(-2, 2, 9), 'y': np.linspace(-2, 2, 5), 'offset': 0.5}
+    return GridSearch(parameter_vectors, objective=quadratic_objective, **kwargs)
+
+
+def test_calculate_parallel_matches_serial():
+    """
+    Test that the results array does not depend on the number of workers or the executor.
+    """
+    serial = get_test_grid_search(use_memo=False).calculate(None).copy()
+    assert serial.shape == (9, 5)
+    assert serial[0, 0] == quadratic_objective(None, {'x': -2, 'y': -2, 'offset': 0.5})
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        threaded = get_test_grid_search(use_memo=False).calculate(None, executor=executor, chunk_size=4)
+    assert np.array_equal(serial, threaded)
+
+    pooled = get_test_grid_search(use_memo=False).calculate(None, n_workers=2)
+    assert np.array_equal(serial, pooled)
+
+
+def test_memo_across_cycles():
+    """
+    Test that points shared between successive grids are looked up rather than recomputed.
+    """
+    gs = get_test_grid_search()
+    gs.calculate(None)
+    assert gs.memo_stats[-1] == {'hits': 0, 'misses': 45}
+
+    gs.generate_empty_results_array()
+    gs.calculate(None)
+    assert gs.memo_stats[-1] == {'hits': 45, 'misses': 0}
+
+    # A refined grid keeps the values either side of the extremum
+    gs.get_global_extremum('min')
+    gs.parameter_vectors = gs.suggest_refined_vectorisation()
+    gs.generate_empty_results_array()
+    gs.calculate(None)
+    assert gs.memo_stats[-1]['hits'] > 0
+    assert gs.memo_stats[-1]['hits'] + gs.memo_stats[-1]['misses'] == gs.results.size
+
+
+def test_memo_bounded_and_saved_incrementally(tmp_path):
+    """
+    Test that the memo stops growing at memo_max_entries, and that checkpoints append only the memo entries added since the last.
+    """
+    gs = get_test_grid_search(memo_max_entries=10)
+    gs.calculate(None)
+    assert len(gs.memo) == 10
+    gs.generate_empty_results_array()
+    gs.calculate(None)
+    assert gs.memo_stats[-1] == {'hits': 10, 'misses': 35}
+
+    gs = get_test_grid_search(checkpoint_directory=tmp_path)
+    gs.calculate(None, flat_indices=np.arange(20))
+    gs.save_checkpoint()
+    n_bytes = (tmp_path / 'memo.pkl').stat().st_size
+    gs.save_checkpoint()
+    assert (tmp_path / 'memo.pkl').stat().st_size == n_bytes
+    gs.calculate(None, flat_indices=np.arange(20, 45))
+    gs.save_checkpoint()
+    assert n_bytes < (tmp_path / 'memo.pkl').stat().st_size < 3 * n_bytes
+    assert b'memos' not in (tmp_path / 'state.pkl').read_bytes()
+
+    # A save cut short is dropped on reloading, and the memo entries saved before it are kept
+    with open(str(tmp_path / 'memo.pkl'), 'ab') as f:
+        f.write(b'\x80\x05truncated')
+    resumed = get_test_grid_search(checkpoint_directory=tmp_path)
+    resumed.completed[...] = False
+    resumed.calculate(None)
+    assert resumed.memo_stats[-1] == {'hits': 45, 'misses': 0}
+
+
+def scaled_objective(data_file, param_set):
+    return param_set['x'] * (10 if data_file == 'B' else 1)
+
+
+def negated_objective(data_file, param_set):
+    return -param_set['x']
+
+
+def test_memo_per_data_file():
+    """
+    Test that memoised and completed results are not reused for a different data_file or objective.
+    """
+    gs = GridSearch({'x': np.arange(5.)}, objective=scaled_objective)
+    assert np.array_equal(gs.calculate('A'), np.arange(5.))
+
+    assert np.array_equal(gs.calculate('B'), 10 * np.arange(5.))
+    assert gs.memo_stats[-1] == {'hits': 0, 'misses': 5}
+
+    gs.generate_empty_results_array()
+    assert np.array_equal(gs.calculate('A'), np.arange(5.))
+    assert gs.memo_stats[-1] == {'hits': 5, 'misses': 0}
+
+    gs.objective = negated_objective
+    assert np.array_equal(gs.calculate('A'), -np.arange(5.))
+    assert gs.memo_stats[-1] == {'hits': 0, 'misses': 5}
+
+
+def parameterised_objective(data_file, param_set, scale=1):
+    return param_set['x'] * scale
+
+
+class ScalingObjective:
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def __call__(self, data_file, param_set):
+        return param_set['x'] * self.scale
+
+
+def test_memo_per_objective_instance(tmp_path):
+    """
+    Test that partials and instances of one class sharing a name don't share memoised or completed results, and that an
+    objective_id matches checkpointed results across searches.
+    """
+    gs = GridSearch({'x': np.arange(5.)}, objective=partial(parameterised_objective, scale=1))
+    assert np.array_equal(gs.calculate('A'), np.arange(5.))
+    gs.objective = partial(parameterised_objective, scale=100)
+    assert np.array_equal(gs.calculate('A'), 100 * np.arange(5.))
+    assert gs.memo_stats[-1] == {'hits': 0, 'misses': 5}
+
+    gs.objective = ScalingObjective(2)
+    gs.calculate('A')
+    gs.objective = ScalingObjective(3)
+    assert np.array_equal(gs.calculate('A'), 3 * np.arange(5.))
+    assert gs.memo_stats[-1] == {'hits': 0, 'misses': 5}
+
+    first = GridSearch({'x': np.arange(5.)}, objective=lambda data_file, param_set: param_set['x'], checkpoint_directory=tmp_path,
+                       objective_id='identity')
+    first.calculate('A')
+    first.save_checkpoint()
+    second = GridSearch({'x': np.arange(5.)}, objective=lambda data_file, param_set: -param_set['x'], checkpoint_directory=tmp_path,
+                        objective_id='negated')
+    assert np.array_equal(second.calculate('A'), -np.arange(5.))
+    assert second.memo_stats[-1] == {'hits': 0, 'misses': 5}
+    third = GridSearch({'x': np.arange(5.)}, objective=lambda data_file, param_set: param_set['x'], checkpoint_directory=tmp_path,
+                       objective_id='identity')
+    third.completed[...] = False
+    assert np.array_equal(third.calculate('A'), np.arange(5.))
+    assert third.memo_stats[-1] == {'hits': 5, 'misses': 0}
+
+
+def test_iter_parameter_combo_chunks():
+    """
+    Test that chunked combo generation covers the grid in order, including tracking and constant parameters.
+    """
+    gs = GridSearch({'a': [1, 2], 'b': np.array([0.1, 0.2, 0.3]), 'c': 'a', 'd': 7.5}, objective=quadratic_objective)
+    chunks = list(gs.iter_parameter_combo_chunks(chunk_size=4))
+    assert [len(combos) for _, combos in chunks] == [4, 2]
+
+    combos, indexers = gs.get_complete_parameter_combos()
+    assert combos[0] == [1, 0.1, 1, 7.5]
+    assert combos[4] == [2, 0.2, 2, 7.5]
+    assert indexers[4] == [1, 1]
+    assert gs.indexers2params([indexers[4]])[0] == dict(zip(gs.parameters, combos[4]))
+
+
+class InterruptingObjective:
+
+    def __init__(self, n_before_failure):
+        self.n_calls = 0
+        self.n_before_failure = n_before_failure
+
+    def __call__(self, data_file, param_set):
+        self.n_calls += 1
+        if self.n_calls > self.n_before_failure:
+            raise KeyboardInterrupt
+        return quadratic_objective(data_file, param_set)
+
+
+def test_checkpoint_resume(tmp_path):
+    """
+    Test that a restarted search reopens the memory-mapped results and only evaluates the points not yet completed.
+    """
+    parameter_vectors = {'x': np.linspace(-2, 2, 9), 'y': np.linspace(-2, 2, 5), 'offset': 0.5}
+    expected = get_test_grid_search(use_memo=False).calculate(None)
+
+    interrupted = GridSearch(parameter_vectors, objective=InterruptingObjective(20), use_memo=False, checkpoint_directory=tmp_path)
+    with pytest.raises(KeyboardInterrupt):
+        interrupted.calculate(None)
+    assert np.count_nonzero(interrupted.completed) == 20
+
+    resumed_objective = InterruptingObjective(100)
+    resumed = GridSearch(parameter_vectors, objective=resumed_objective, use_memo=False, checkpoint_directory=tmp_path)
+    assert isinstance(resumed.results, np.memmap)
+    resumed.calculate(None)
+    assert resumed_objective.n_calls == 25
+    assert np.array_equal(resumed.results, expected)
+    assert resumed.completed.all()
+
+    # A search with another objective in the same directory does not reuse the checkpointed results or memo
+    other = GridSearch(parameter_vectors, objective=negated_objective, checkpoint_directory=tmp_path)
+    assert np.array_equal(other.calculate(None), -np.broadcast_to(parameter_vectors['x'][:, None], (9, 5)))
+    assert other.memo_stats[-1] == {'hits': 0, 'misses': 45}
+
+
+def quadratic_batch_objective(data_file, columns):
+    return (columns['x'] - 1.2)**2 + (columns['y'] + 0.4)**2 + columns['offset']
+
+
+def test_batch_objective():
+    """
+    Test that a batch objective scoring parameter columns gives the same results as the per-point objective.
+    """
+    expected = get_test_grid_search(use_memo=False).calculate(None)
+
+    parameter_vectors = {'x': np.linspace(-2, 2, 9), 'y': np.linspace(-2, 2, 5), 'offset': 0.5}
+    gs = GridSearch(parameter_vectors, objective=quadratic_batch_objective, batch_objective=True)
+    assert np.allclose(gs.calculate(None, chunk_size=7), expected)
+
+    gs = GridSearch(parameter_vectors, objective=quadratic_batch_objective, batch_objective=True)
+    assert np.allclose(gs.calculate(None, n_workers=2), expected)
+
+
+def budgeted_objective(data_file, param_set):
+    # Low budgets give a noisier estimate of the quadratic objective
+    return quadratic_objective(data_file, param_set) + 1 / param_set['budget'] * np.sin(10 * param_set['x'])
+
+
+def test_sampled_searches():
+    """
+    Test that the random, Latin hypercube and successive halving searches only evaluate the sampled points.
+    """
+    parameter_vectors = {'x': np.linspace(-2, 2, 41), 'y': np.linspace(-2, 2, 21), 'offset': 0.5}
+
+    gs = GridSearch(parameter_vectors, objective=quadratic_objective)
+    extr, extr_indexers = gs.random_search(None, 100, 'min', seed=1)
+    assert np.count_nonzero(gs.completed) == 100
+    assert np.count_nonzero(~np.isnan(gs.results)) == 100
+    assert extr == gs.results[tuple(extr_indexers[0])]
+
+    gs = GridSearch(dict(parameter_vectors, x=np.linspace(-2, 2, 40)), objective=quadratic_objective)
+    extr, extr_indexers = gs.latin_hypercube_search(None, 20, 'min', seed=1)
+    assert np.count_nonzero(gs.completed) == 20
+    # Each stratum of each parameter is sampled exactly once, so no x value is repeated
+    assert len(set(np.nonzero(gs.completed)[0])) == 20
+
+    gs = GridSearch(parameter_vectors, objective=budgeted_objective)
+    extr, extr_indexers = gs.successive_halving(None, 81, 'min', min_budget=1, max_budget=81, eta=3, seed=1)
+    assert [rung['n_candidates'] for rung in gs.halving_history] == [81, 27, 9, 3, 1]
+    assert [rung['budget'] for rung in gs.halving_history] == [1, 3, 9, 27, 81]
+    assert np.count_nonzero(gs.completed) == 1
+    assert extr < 0.7
+
+
+def test_extrema_tracker():
+    """
+    Test that the streaming extrema match a full scan of the results, including ties.
+    """
+    gs = get_test_grid_search(top_k=3)
+    gs.calculate(None, chunk_size=4)
+    assert gs.extrema_tracker.n_seen == 45
+
+    assert [value for value, _ in gs.extrema_tracker.top('min')] == sorted(gs.results.reshape(-1))[:3]
+    assert [value for value, _ in gs.extrema_tracker.top('max')] == sorted(gs.results.reshape(-1))[-3:][::-1]
+    extr, extr_indexers = gs.get_global_extremum('min')
+    assert extr == np.amin(gs.results)
+    assert extr_indexers == [list(index) for index in zip(*np.where(gs.results == extr))]
+
+    value, param_set = gs.get_best_so_far('max')
+    assert value == np.amax(gs.results)
+    assert param_set == {'x': -2.0, 'y': 2.0, 'offset': 0.5}
+
+    # The four corners of a symmetric objective tie, which is more than the tracker holds
+    gs = GridSearch({'x': np.linspace(-1, 1, 5), 'y': np.linspace(-1, 1, 5)}, objective=lambda data_file, p: p['x']**2 + p['y']**2, top_k=3)
+    gs.calculate(None)
+    extr, extr_indexers = gs.get_global_extremum('max')
+    assert extr_indexers == [[0, 0], [0, 4], [4, 0], [4, 4]]
+    assert len(gs.get_near_extrema('max', 0.0)) == 3
+
+
+def test_auto_optimise_early_stopping():
+    """
+    Test that auto_optimise stops refining on convergence of the extremum, and on an evaluation budget.
+    """
+    gs = get_test_grid_search()
+    gs.auto_optimise(None, None, 20, 'min', convergence_perc=1)
+    assert len(gs.auto_optimised_extrema) == 3
+    assert 'extremum changed by less than' in gs.auto_optimise_stop_reason
+    assert abs(gs.auto_optimised_extrema[-1] - 0.5) < 0.02
+
+    gs = get_test_grid_search()
+    gs.auto_optimise(None, None, 20, 'min', max_evaluations=60)
+    assert gs.n_evaluations == 60
+    assert len(gs.auto_optimised_extrema) == 2
+    assert 'budget' in gs.auto_optimise_stop_reason
+
+    # A budget used up before any point is evaluated records no cycles
+    for budget in [{'max_seconds': 0}, {'max_evaluations': 0}]:
+        gs = get_test_grid_search()
+        gs.auto_optimise(None, None, 20, 'min', **budget)
+        assert gs.n_evaluations == 0
+        assert gs.auto_optimised_extrema == []
+        assert 'budget' in gs.auto_optimise_stop_reason
+
+    # Points submitted to an executor count against the budget, so it is not overrun by the chunks in flight
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        gs = get_test_grid_search()
+        gs.calculate(None, executor=executor, chunk_size=4, max_evaluations=10)
+        assert gs.n_evaluations == 10
+        assert np.count_nonzero(gs.completed) == 10
+
+        gs = GridSearch(gs.parameter_vectors, objective=quadratic_batch_objective, batch_objective=True)
+        gs.calculate(None, executor=executor, max_evaluations=10)
+        assert gs.n_evaluations == 10
+
+        gs = get_test_grid_search()
+        gs.auto_optimise(None, None, 20, 'min', max_evaluations=10, executor=executor)
+        assert gs.n_evaluations == 10
+        assert 'budget' in gs.auto_optimise_stop_reason
+
+    # A parameter whose optimum has stopped moving is fixed for the later grids
+    gs = get_test_grid_search(perc_limit=5)
+    gs.auto_optimise(None, None, 8, 'min')
+    assert min(len(vectors['x']) for vectors in gs.auto_optimised_vectorisations) == 1
+
+
+N_DATASET_LOADS = []
+
+
+def load_test_dataset(data_file):
+    N_DATASET_LOADS.append(data_file)
+    return {'prices': np.linspace(0, 1, 1000), 'volumes': np.arange(1000)}
+
+
+def dataset_objective(dataset, param_set):
+    assert not dataset['prices'].flags.writeable
+    return float(np.mean(dataset['prices'] * param_set['x']) + dataset['volumes'][int(param_set['y'])])
+
+
+def test_shared_dataset():
+    """
+    Test that the dataset is loaded once and handed to the objective serially and in worker processes.
+    """
+    parameter_vectors = {'x': np.linspace(-2, 2, 9), 'y': [0, 1, 2]}
+    serial = GridSearch(parameter_vectors, objective=dataset_objective, dataset_loader=load_test_dataset, use_memo=False)
+    serial.calculate('data.csv')
+    serial.calculate('data.csv')
+    assert N_DATASET_LOADS == ['data.csv']
+    assert serial.results[8, 2] == 2 * 0.5 + 2
+
+    pooled = GridSearch(parameter_vectors, objective=dataset_objective, dataset_loader=load_test_dataset)
+    pooled.calculate('data.csv', n_workers=2)
+    assert np.array_equal(serial.results, pooled.results)
+    pooled.release_dataset()
+    serial.release_dataset()
+
+
+def test_export_grid(tmp_path):
+    """
+    Test that the grids of an auto_optimise run can be exported and loaded back for analysis.
+    """
+    gs = get_test_grid_search()
+    gs.auto_optimise(None, None, 3, 'min', export_directory=tmp_path)
+
+    archives = GridSearchArchive.load_directory(tmp_path)
+    assert [archive.cycle for archive in archives] == [0, 1, 2]
+    assert archives[-1].extremum == gs.auto_optimised_extrema[-1]
+    assert archives[-1].extremum_param_set == {key: float(value) for key, value in gs.auto_optimised_extrema_param_sets[-1].items()}
+    assert np.array_equal(archives[-1].results, gs.results)
+    assert np.array_equal(archives[1].parameter_vectors['y'], gs.auto_optimised_vectorisations[1]['y'])
+    assert archives[0].parameter_vectors['offset'] == 0.5
+    for archive in archives:
+        archive.close()
+
+
+def run_failing_socket_worker(address, authkey):
+    # Takes a task and disconnects without returning it
+    conn = Client(address, authkey=authkey)
+    conn.recv()
+    conn.close()
+
+
+def test_socket_executor():
+    """
+    Test that socket workers fill the results grid, and that tasks of a failed worker are leased again.
+    """
+    expected = get_test_grid_search(use_memo=False).calculate(None)
+
+    # The working workers only connect once the failing worker has taken a task and disconnected
+    executor = SocketExecutor(lease_seconds=10)
+
+    # Only connections with the executor's random authkey are accepted
+    assert len(executor.authkey) == 32
+    with pytest.raises(AuthenticationError):
+        Client(executor.address, authkey=b'nicpy-gridsearch')
+    failing_worker = threading.Thread(target=run_failing_socket_worker, args=(executor.address, executor.authkey))
+    workers = [threading.Thread(target=run_socket_worker, args=(executor.address, executor.authkey.hex())) for _ in range(2)]
+    def start_workers():
+        failing_worker.join()
+        for worker in workers:
+            worker.start()
+    failing_worker.start()
+    threading.Thread(target=start_workers).start()
+
+    gs = get_test_grid_search()
+    gs.auto_optimise(None, None, 2, 'min', executor=executor, chunk_size=5)
+    assert np.array_equal(gs.auto_optimised_vectorisations[0]['x'], np.linspace(-2, 2, 9))
+    assert executor.n_releases == 1
+    assert executor.n_workers_connected == 3
+
+    executor.shutdown()
+    for worker in workers:
+        worker.join(timeout=5)
+        assert not worker.is_alive()
+
+    reference = get_test_grid_search()
+    reference.auto_optimise(None, None, 2, 'min')
+    assert np.array_equal(gs.results, reference.results)
+    assert gs.auto_optimised_extrema == reference.auto_optimised_extrema
+
+
+def test_surrogate_pruning():
+    """
+    Test that a surrogate skips refined grid points predicted to be worse than the best so far, without losing the optimum.
+    """
+    parameter_vectors = {'x': np.linspace(-2, 2, 9), 'y': np.linspace(-2, 2, 9), 'offset': 0.5}
+    reference = GridSearch(parameter_vectors, objective=quadratic_objective)
+    reference.auto_optimise(None, None, 4, 'min')
+
+    gs = GridSearch(parameter_vectors, objective=quadratic_objective, surrogate='quadratic')
+    gs.auto_optimise(None, None, 4, 'min')
+    assert gs.surrogate_stats[0]['predicted'] == 0
+    assert sum(stats['predicted'] for stats in gs.surrogate_stats) > 0
+    assert gs.n_evaluations < reference.n_evaluations
+    assert gs.auto_optimised_extrema[-1] == reference.auto_optimised_extrema[-1]
+    assert np.all(np.isnan(gs.results[gs.predicted]))
+    assert np.all(~np.isnan(gs.predicted_results[gs.predicted]))
+
+    # The surrogate is fitted to the memo, so options without one are refused
+    with pytest.raises(Exception):
+        GridSearch(parameter_vectors, objective=quadratic_objective, surrogate='quadratic', use_memo=False)
+    with pytest.raises(Exception):
+        GridSearch(parameter_vectors, objective=quadratic_batch_objective, surrogate='quadratic', batch_objective=True)
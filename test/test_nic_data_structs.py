@@ -0,0 +1,507 @@
+import pytest, pickle, threading, asyncio, timeit
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from nicpy.nic_data_structs import CacheDict, AsyncCacheDict, PriorityQueue, cached, normalise_key, _PersistedValue
+
+
+class CountingFunction:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, x):
+        self.calls.append(x)
+        return x * 2
+
+
+def square(x):
+    return x**2
+
+
+def get_shared_squares(persist_directory, xs):
+    cache = CacheDict(square, persist_directory=persist_directory, persist_filename='shared.dat', shared=True)
+    return [cache.get_key_value((x,)) for x in xs]
+
+
+def test_cache_dict_eviction_policies():
+    """
+    Test that max_entries evicts the least recently used entry under 'lru' and the least frequently used under 'lfu'.
+    """
+    lru_cache = CacheDict(square, max_entries=2)
+    lru_cache.get_key_value((1,))
+    lru_cache.get_key_value((2,))
+    lru_cache.get_key_value((1,))
+    lru_cache.get_key_value((3,))
+    assert set(lru_cache.cache_dict) == {normalise_key((1,)), normalise_key((3,))}
+    assert lru_cache.n_evictions == 1
+
+    lfu_cache = CacheDict(square, max_entries=2, eviction_policy='lfu')
+    for x in [1, 1, 1, 2, 2, 3]:
+        lfu_cache.get_key_value((x,))
+    assert set(lfu_cache.cache_dict) == {normalise_key((1,)), normalise_key((3,))}
+
+    # The hit count buckets evict as a brute force search for the fewest hits (ties to the least recently used) would
+    lfu_cache = CacheDict(square, max_entries=20, eviction_policy='lfu')
+    reference_hits, reference_order = {}, []
+    for x in np.random.default_rng(0).zipf(1.5, 2000) % 50:
+        lfu_cache.get_key_value((int(x),))
+        if x in reference_hits:
+            reference_hits[x] += 1
+            reference_order.remove(x)
+        else:
+            if len(reference_hits) == 20:
+                evicted = min(reference_order, key=lambda y: reference_hits[y])
+                reference_order.remove(evicted)
+                del reference_hits[evicted]
+            reference_hits[x] = 0
+        reference_order.append(x)
+    assert set(lfu_cache.cache_dict) == {normalise_key((int(x),)) for x in reference_hits}
+    assert lfu_cache.n_evictions > 100
+
+    # max_bytes bounds the total pickled size of the values
+    bytes_cache = CacheDict(lambda n: 'a' * n, max_bytes=250)
+    for n in [100, 101, 102]:
+        bytes_cache.get_key_value((n,))
+    assert set(bytes_cache.cache_dict) == {normalise_key((101,)), normalise_key((102,))}
+    assert bytes_cache.n_bytes <= 250
+
+
+def test_cache_dict_entry_lifetime():
+    """
+    Test that entries older than entry_lifetime_hours are recomputed on access.
+    """
+    func = CountingFunction()
+    cache = CacheDict(func, entry_lifetime_hours=1)
+    assert cache.get_key_value((4,)) == 8
+    assert cache.get_key_value((4,)) == 8
+    assert func.calls == [4]
+
+    cache.entry_info[normalise_key((4,))]['save_datetime'] = datetime.now() - timedelta(hours=2)
+    assert cache.get_key_value((4,)) == 8
+    assert func.calls == [4, 4]
+    assert cache.n_expirations == 1
+
+
+def test_cache_dict_log_persistence(tmp_path):
+    """
+    Test that persisted entries are appended to the log, reloaded lazily and compacted when the log grows.
+    """
+    func = CountingFunction()
+    cache = CacheDict(func, persist_directory=tmp_path, persist_filename='cache.dat', compaction_ratio=2)
+    for x in range(5):
+        cache.get_key_value((x,))
+    sizes = [cache.persist_filepath.stat().st_size]
+    cache.get_key_value((5,))
+    sizes.append(cache.persist_filepath.stat().st_size)
+    cache.delete_key((0,))
+    assert sizes[1] > sizes[0]
+    assert cache._n_log_records == 7
+
+    reloaded = CacheDict(func, persist_directory=tmp_path, persist_filename='cache.dat')
+    assert list(reloaded.cache_dict) == [normalise_key((x,)) for x in range(1, 6)]
+    assert all(isinstance(value, _PersistedValue) for value in reloaded.cache_dict.values())
+    assert reloaded.get_key_value((3,)) == 6
+    assert func.calls == list(range(6))
+
+    # Overwriting entries grows the log past compaction_ratio times the 10 entry minimum, so it is rewritten
+    for _ in range(3):
+        for x in range(1, 6):
+            reloaded.delete_key((x,))
+            reloaded.force_key_value((x,), x)
+    assert reloaded._n_log_records < 20
+    assert reloaded.get_key_value((2,)) == 2
+    assert CacheDict(func, persist_directory=tmp_path, persist_filename='cache.dat').get_key_value((4,)) == 4
+
+
+def value_of(x):
+    return 'value-{}'.format(x)
+
+
+def test_cache_dict_lazy_values_after_compaction(tmp_path):
+    """
+    Test that lazily loaded values are not read from a persist file another instance has compacted since.
+    """
+    writer = CacheDict(value_of, persist_directory=tmp_path, persist_filename='cache.dat')
+    writer.get_many([(x,) for x in range(20)])
+
+    lazy = CacheDict(value_of, persist_directory=tmp_path, persist_filename='cache.dat')
+    compacting = CacheDict(value_of, persist_directory=tmp_path, persist_filename='cache.dat')
+    for x in range(0, 20, 2):
+        compacting.delete_key((x,))
+    compacting.compact()
+
+    assert lazy.get_many([(x,) for x in range(20)]) == [value_of(x) for x in range(20)]
+    assert lazy.n_hits == 10 and lazy.n_misses == 10
+    assert CacheDict(value_of, persist_directory=tmp_path, persist_filename='cache.dat').get_key_value((7,)) == 'value-7'
+
+
+def test_cache_dict_loads_single_pickle_files(tmp_path):
+    """
+    Test that files persisted as a single pickled CacheDict are loaded, then rewritten as a log.
+    """
+    old_cache = CacheDict(square)
+    old_cache.cache_dict = {('3',): 9}
+    with open(str(tmp_path / 'cache.dat'), 'wb') as f:
+        pickle.dump({'CacheDict': old_cache, 'save_datetime': datetime.now()}, f)
+
+    cache = CacheDict(square, persist_directory=tmp_path, persist_filename='cache.dat')
+    assert cache.get_key_value(('3',)) == 9
+    cache.get_key_value((4,))
+    reloaded = CacheDict(square, persist_directory=tmp_path, persist_filename='cache.dat')
+    assert set(reloaded.cache_dict) == {normalise_key(('3',)), normalise_key((4,))}
+
+
+def test_cache_dict_single_flight():
+    """
+    Test that concurrent misses on one key share a single call, while different keys compute in parallel.
+    """
+    barrier, calls = threading.Barrier(2, timeout=5), []
+
+    def slow_func(x):
+        calls.append(x)
+        barrier.wait()
+        return x + 1
+
+    cache = CacheDict(slow_func)
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda x: cache.get_key_value((x,)), [1, 2] * 4))
+    assert results == [2, 3] * 4
+    assert sorted(calls) == [1, 2]
+    assert cache._in_flight == {}
+
+
+def test_cache_dict_get_many(tmp_path):
+    """
+    Test that get_many returns values in key order, computing each distinct miss once and appending them in one write.
+    """
+    func = CountingFunction()
+    cache = CacheDict(func, persist_directory=tmp_path, persist_filename='cache.dat')
+    cache.get_key_value((1,))
+    n_persists = []
+    persist = cache._persist
+    cache._persist = lambda: n_persists.append(1) or persist()
+
+    with ThreadPoolExecutor(4) as executor:
+        assert cache.get_many([(1,), (2,), (3,), (2,), (4,)], executor=executor) == [2, 4, 6, 4, 8]
+    assert sorted(func.calls) == [1, 2, 3, 4]
+    assert len(n_persists) == 1
+    assert cache.get_many([(4,), (3,)]) == [8, 6]
+    assert set(CacheDict(func, persist_directory=tmp_path, persist_filename='cache.dat').cache_dict) == {normalise_key((x,)) for x in range(1, 5)}
+
+    with pytest.raises(ZeroDivisionError):
+        CacheDict(lambda x: 1 / x).get_many([(1,), (0,)])
+
+
+def test_async_cache_dict(tmp_path):
+    """
+    Test that concurrent awaiters of a key share one call of the coroutine function, and that entries are persisted.
+    """
+    calls = []
+
+    async def fetch(x):
+        calls.append(x)
+        await asyncio.sleep(0.01)
+        return x * 10
+
+    async def run():
+        cache = AsyncCacheDict(fetch, persist_directory=tmp_path, persist_filename='cache.dat')
+        results = await asyncio.gather(cache.get_key_value((1,)), cache.get_key_value((1,)), cache.get_many([(2,), (1,), (2,)]))
+        return cache, results
+
+    cache, results = asyncio.run(run())
+    assert results == [10, 10, [20, 10, 20]]
+    assert sorted(calls) == [1, 2]
+
+    # Lazily persisted values are read in the loop's executor rather than on the loop's thread
+    value_threads = []
+
+    class RecordingAsyncCacheDict(AsyncCacheDict):
+        def _get_value(self, key):
+            value_threads.append(threading.current_thread())
+            return super()._get_value(key)
+
+    assert asyncio.run(RecordingAsyncCacheDict(fetch, persist_directory=tmp_path, persist_filename='cache.dat').get_key_value((2,))) == 20
+    assert sorted(calls) == [1, 2]
+    assert value_threads and threading.main_thread() not in value_threads
+
+    with pytest.raises(Exception):
+        AsyncCacheDict(square)
+
+
+def test_async_cache_dict_hits_stay_on_the_loop():
+    """
+    Test that in-memory hits don't use the loop's executor, and that a thread holding the cache's lock doesn't block the loop.
+    """
+    async def fetch(x):
+        return x * 10
+
+    class CountingExecutor(ThreadPoolExecutor):
+        n_submits = 0
+
+        def submit(self, *args, **kwargs):
+            CountingExecutor.n_submits += 1
+            return super().submit(*args, **kwargs)
+
+    async def run():
+        asyncio.get_running_loop().set_default_executor(CountingExecutor())
+        cache = AsyncCacheDict(fetch)
+        assert await cache.get_key_value((1,)) == 10
+        n_submits = CountingExecutor.n_submits
+        assert await cache.get_many([(1,), (1,)]) == [10, 10]
+        assert CountingExecutor.n_submits == n_submits
+
+        # The loop keeps running while another thread holds the lock, and the hit is served once it is released
+        locked, release = threading.Event(), threading.Event()
+
+        def hold_lock():
+            with cache._lock:
+                locked.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        locked.wait()
+        get = asyncio.ensure_future(cache.get_key_value((1,)))
+        await asyncio.sleep(0.05)
+        assert not get.done()
+        release.set()
+        assert await get == 10
+        thread.join()
+        assert CountingExecutor.n_submits > n_submits
+
+    asyncio.run(run())
+
+
+def test_cache_dict_key_normalisation():
+    """
+    Test that keys distinguish argument types, that equal containers share a key, and that force_key_value/delete_key
+    use the same keys as get_key_value.
+    """
+    assert len({normalise_key((1,)), normalise_key(('1',)), normalise_key((1.0,)), normalise_key((True,))}) == 4
+    assert normalise_key(({'a': [1, 2], 'b': None},)) == normalise_key(({'b': None, 'a': [1, 2]},))
+    assert normalise_key(([1, 2],)) != normalise_key(((1, 2),))
+    assert normalise_key((np.arange(3),)) == normalise_key((np.arange(3),)) != normalise_key((np.arange(3.),))
+    df = pd.DataFrame({'a': [1, 2], 'b': ['x', 'y']})
+    assert normalise_key((df,)) == normalise_key((df.copy(),)) != normalise_key((df.rename(columns={'b': 'c'}),))
+
+    func = CountingFunction()
+    cache = CacheDict(func)
+    cache.force_key_value((2,), 'forced')
+    assert cache.get_key_value((2,)) == 'forced'
+    assert cache.get_key_value(('2',)) == '22'
+    cache.delete_key((2,))
+    assert cache.get_key_value((2,)) == 4
+
+
+def test_normalise_key_flat_container_speed():
+    """
+    Test that flat lists of primitives are hashed with distinct keys per element type, and not much slower than keying
+    them by their elements' str.
+    """
+    assert len({normalise_key(([1, 2],)), normalise_key(([1.0, 2],)), normalise_key((['1', 2],)), normalise_key(([True, 2],)),
+                normalise_key(([[1], 2],)), normalise_key(((1, 2),))}) == 6
+    key = (list(range(1000)),)
+    normalise_seconds = min(timeit.repeat(lambda: normalise_key(key), number=20, repeat=5))
+    str_seconds = min(timeit.repeat(lambda: tuple(str(el) for el in key), number=20, repeat=5))
+    assert normalise_seconds < 4 * str_seconds
+
+
+def test_shared_cache_dict(tmp_path):
+    """
+    Test that entries persisted by one shared CacheDict are visible to another using the same file, including after compaction.
+    """
+    func = CountingFunction()
+    cache1 = CacheDict(func, persist_directory=tmp_path, persist_filename='shared.dat', shared=True)
+    cache2 = CacheDict(func, persist_directory=tmp_path, persist_filename='shared.dat', shared=True)
+    assert cache1.get_key_value((1,)) == 2
+    assert cache2.get_key_value((1,)) == 2
+    assert cache2.get_key_value((2,)) == 4
+    assert cache1.get_key_value((2,)) == 4
+    assert func.calls == [1, 2]
+
+    cache1.compact()
+    cache1.delete_key((1,))
+    assert cache2.get_key_value((3,)) == 6
+    assert set(cache2.cache_dict) == {normalise_key((2,)), normalise_key((3,))}
+    assert cache1.get_key_value((3,)) == 6
+    assert func.calls == [1, 2, 3]
+
+    # Processes writing to the same file concurrently lose none of each other's entries
+    with ProcessPoolExecutor(3) as executor:
+        list(executor.map(get_shared_squares, [tmp_path] * 3, [range(0, 20), range(10, 30), range(20, 40)]))
+    reloaded = CacheDict(square, persist_directory=tmp_path, persist_filename='shared.dat')
+    assert set(reloaded.cache_dict) == {normalise_key((x,)) for x in range(40)}
+
+
+def test_shared_cache_dict_compaction_keeps_evicted_entries(tmp_path):
+    """
+    Test that a shared CacheDict compacting the persist file keeps the entries it has evicted from memory.
+    """
+    writer = CacheDict(square, persist_directory=tmp_path, persist_filename='shared.dat', shared=True)
+    for x in range(30):
+        writer.get_key_value((x,))
+    small = CacheDict(square, persist_directory=tmp_path, persist_filename='shared.dat', shared=True, max_entries=5)
+    for x in range(30, 70):
+        small.get_key_value((x,))
+    assert len(small.cache_dict) == 5
+    small.compact()
+    reloaded = CacheDict(square, persist_directory=tmp_path, persist_filename='shared.dat')
+    assert set(reloaded.cache_dict) == {normalise_key((x,)) for x in range(70)}
+    assert [reloaded.get_key_value((x,)) for x in range(70)] == [x**2 for x in range(70)]
+
+
+def test_cache_dict_stale_while_revalidate():
+    """
+    Test that stale entries are served immediately and refreshed in the background, while hard-expired ones are recomputed.
+    """
+    refresh_started, release_refresh, calls = threading.Event(), threading.Event(), []
+
+    def versioned_func(x):
+        calls.append(x)
+        if len(calls) > 1:
+            refresh_started.set()
+            release_refresh.wait(5)
+        return len(calls)
+
+    cache = CacheDict(versioned_func, stale_after_hours=1, entry_lifetime_hours=10)
+    assert cache.get_key_value((0,)) == 1
+    cache.entry_info[normalise_key((0,))]['save_datetime'] = datetime.now() - timedelta(hours=2)
+    assert cache.get_key_value((0,)) == 1
+    assert refresh_started.wait(5)
+    assert cache.get_key_value((0,)) == 1
+    assert cache.n_refreshes == 1
+    release_refresh.set()
+    cache._refresh_executor.shutdown(wait=True)
+    assert cache.get_key_value((0,)) == 2
+
+    cache.entry_info[normalise_key((0,))]['save_datetime'] = datetime.now() - timedelta(hours=11)
+    assert cache.get_key_value((0,)) == 3
+    assert cache.n_refreshes == 1
+
+    # AsyncCacheDict refreshes in a task on the running loop
+    async def async_func(x):
+        calls.append(x)
+        return len(calls)
+
+    async def run():
+        async_cache = AsyncCacheDict(async_func, stale_after_hours=1)
+        first = await async_cache.get_key_value((0,))
+        async_cache.entry_info[normalise_key((0,))]['save_datetime'] = datetime.now() - timedelta(hours=2)
+        stale = await async_cache.get_key_value((0,))
+        await asyncio.gather(*async_cache._refresh_tasks)
+        return first, stale, await async_cache.get_key_value((0,))
+
+    assert asyncio.run(run()) == (4, 4, 5)
+
+
+def test_cached_decorator_and_metrics(tmp_path):
+    """
+    Test that the cached decorator keys calls on their bound arguments with defaults applied, and reports its metrics.
+    """
+    calls = []
+
+    @cached(persist_directory=tmp_path, max_entries=2)
+    def scale(x, factor=2, *extra, offset=0, **options):
+        calls.append(x)
+        return x * factor + offset + sum(extra) + len(options)
+
+    assert scale(1) == scale(x=1) == scale(1, 2) == scale(1, factor=2, offset=0) == 2
+    assert scale(1, 3, 4, offset=1, verbose=True) == 9
+    assert scale(1, 3, 4, verbose=True, offset=1) == 9
+    assert calls == [1, 1]
+    assert scale.__name__ == 'scale'
+    assert (tmp_path / 'scale.dat').exists()
+
+    scale(5)
+    metrics = scale.cache.metrics()
+    assert (metrics['n_hits'], metrics['n_misses'], metrics['n_evictions'], metrics['n_entries']) == (4, 3, 1, 2)
+    assert metrics['compute_seconds'] >= 0 and metrics['persist_seconds'] > 0
+
+    @cached
+    async def fetch(x, y=1):
+        return x + y
+
+    assert asyncio.run(fetch(1)) == asyncio.run(fetch(x=1, y=1)) == 2
+    assert fetch.cache.metrics()['n_hits'] == 1
+
+
+@pytest.mark.parametrize('codec', [None, 'gzip', 'zlib', 'lzma', 'zstd', 'lz4'])
+def test_cache_dict_codecs(tmp_path, codec):
+    """
+    Test that values persisted with each codec are reloaded lazily and decoded on access, with compressed sizes accounted.
+    """
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    elif codec == 'lz4':
+        pytest.importorskip('lz4')
+
+    def make_table(n):
+        return pd.DataFrame({'a': np.arange(n) % 3, 'b': ['x'] * n})
+
+    cache = CacheDict(make_table, persist_directory=tmp_path, persist_filename='cache.dat', codec=codec)
+    cache.get_key_value((1000,))
+    n_bytes = cache.entry_info[normalise_key((1000,))]['n_bytes']
+    assert cache.n_bytes == n_bytes
+    if codec is not None:
+        assert n_bytes < len(pickle.dumps(make_table(1000)))
+
+    reloaded = CacheDict(make_table, persist_directory=tmp_path, persist_filename='cache.dat')
+    assert isinstance(reloaded.cache_dict[normalise_key((1000,))], _PersistedValue)
+    pd.testing.assert_frame_equal(reloaded.get_key_value((1000,)), make_table(1000))
+
+
+def test_cache_dict_parquet_dataframes(tmp_path):
+    """
+    Test that DataFrames are stored as Parquet when parquet_dataframes is set, and other values are still pickled.
+    """
+    pytest.importorskip('pyarrow')
+    cache = CacheDict(lambda n: pd.DataFrame({'a': np.arange(n)}) if n else 'empty', persist_directory=tmp_path,
+                      persist_filename='cache.dat', parquet_dataframes=True)
+    cache.get_many([(10,), (0,)])
+    assert cache.entry_info[normalise_key((10,))]['encoding'] == ('parquet', None)
+    assert cache.entry_info[normalise_key((0,))]['encoding'] == ('pickle', None)
+    reloaded = CacheDict(cache.func, persist_directory=tmp_path, persist_filename='cache.dat')
+    pd.testing.assert_frame_equal(reloaded.get_key_value((10,)), pd.DataFrame({'a': np.arange(10)}))
+    assert reloaded.get_key_value((0,)) == 'empty'
+
+
+def test_priority_queue():
+    """
+    Test priority updates, removal, membership, bulk construction and insertion-order tie-breaking of PriorityQueue.
+    """
+    queue = PriorityQueue([('a', 5), ('b', 1), ('c', 3), ('d', 3)])
+    assert len(queue) == 4 and 'a' in queue and 'e' not in queue
+
+    queue.update_priority('a', 0)
+    queue.put('c', 2)
+    queue.remove('b')
+    queue.put('e', 2)
+    assert 'b' not in queue and queue.priority('c') == 2
+    with pytest.raises(KeyError):
+        queue.remove('b')
+    assert queue.peek() == 'a'
+    assert [queue.get() for _ in range(len(queue))] == ['a', 'c', 'e', 'd']
+    assert queue.empty() and queue.elements == [] and queue.n_removed == 0
+    with pytest.raises(IndexError):
+        queue.get()
+
+    # Unorderable items with equal priorities are never compared
+    nodes = [object() for _ in range(3)]
+    for node in nodes:
+        queue.put(node, 1)
+    assert [queue.get() for _ in nodes] == nodes
+
+    # Removed entries are purged once they outnumber the live ones
+    queue = PriorityQueue((i, i) for i in range(10))
+    for i in range(6):
+        queue.remove(i)
+    assert len(queue.elements) == 4 and queue.get() == 6
+
+    # Repeated priority updates do not grow the heap
+    queue = PriorityQueue((i, i) for i in range(10))
+    for round_ in range(999):
+        for i in range(10):
+            queue.update_priority(i, (i * 7 + round_) % 10)
+    assert len(queue) == 10 and len(queue.elements) <= 21
+    assert [queue.priority(i) for i in range(10)] == [(i * 7 + 998) % 10 for i in range(10)]
@@ -0,0 +1,84 @@
+import pytest, heapq
+import numpy as np
+from nicpy.nic_pathfinding import GridPathfinder, DIAGONAL_COST
+
+
+def get_random_occupancy(shape, block_fraction, seed):
+    occupancy = np.random.default_rng(seed).random(shape) < block_fraction
+    occupancy[0, 0] = occupancy[-1, -1] = False
+    return occupancy
+
+
+# Plain dict-based Dijkstra, for reference costs
+def reference_costs(occupancy, start, diagonal=True):
+    moves = [(-1, 0), (1, 0), (0, -1), (0, 1)] + ([(-1, -1), (-1, 1), (1, -1), (1, 1)] if diagonal else [])
+    costs, heap = {start: 0.}, [(0., start)]
+    while heap:
+        cost, (row, col) = heapq.heappop(heap)
+        if cost > costs[(row, col)]:
+            continue
+        for d_row, d_col in moves:
+            neighbour = (row + d_row, col + d_col)
+            if not (0 <= neighbour[0] < occupancy.shape[0] and 0 <= neighbour[1] < occupancy.shape[1]) or occupancy[neighbour]:
+                continue
+            # No cutting the corners of blocked cells
+            if d_row and d_col and (occupancy[row + d_row, col] or occupancy[row, col + d_col]):
+                continue
+            new_cost = cost + (DIAGONAL_COST if d_row and d_col else 1.)
+            if new_cost < costs.get(neighbour, np.inf):
+                costs[neighbour] = new_cost
+                heapq.heappush(heap, (new_cost, neighbour))
+    return costs
+
+
+def assert_valid_path(occupancy, path, start, goal):
+    assert tuple(path[0]) == start and tuple(path[-1]) == goal
+    assert not occupancy[tuple(path.T)].any()
+    steps = np.abs(np.diff(path, axis=0))
+    assert steps.max() == 1
+
+
+@pytest.mark.parametrize('heuristic, jps', [('default', False), ('euclidian', False), (None, False), ('default', True)])
+def test_grid_pathfinder_costs_are_optimal(heuristic, jps):
+    """
+    Test that A*, Dijkstra and jump point search find paths as short as a reference Dijkstra, on random grids.
+    """
+    for seed in range(5):
+        occupancy = get_random_occupancy((30, 40), 0.3, seed)
+        costs = reference_costs(occupancy, (0, 0))
+        goals = [(29, 39), (15, 5), (3, 35)]
+        results = GridPathfinder(occupancy).find_paths((0, 0), goals, heuristic=heuristic, jps=jps)
+        for goal in goals:
+            path, cost = results[goal]
+            if goal in costs and not occupancy[goal]:
+                assert cost == pytest.approx(costs[goal])
+                assert_valid_path(occupancy, path, (0, 0), goal)
+                assert np.sum(np.where(np.abs(np.diff(path, axis=0)).sum(axis=1) == 2, DIAGONAL_COST, 1.)) == pytest.approx(cost)
+            else:
+                assert path is None and cost == np.inf
+
+
+def test_grid_pathfinder_reuse_and_updates():
+    """
+    Test repeated searches on one GridPathfinder, 4-connected searches, blocked cells and unreachable goals.
+    """
+    occupancy = np.zeros((5, 5), dtype=bool)
+    occupancy[1:, 2] = True
+    pathfinder = GridPathfinder(occupancy)
+    path, cost = pathfinder.find_path((4, 0), (4, 4))
+    # Around the wall through (0, 2), which can't be entered diagonally past the wall's corner
+    assert cost == pytest.approx(8 + 2 * DIAGONAL_COST)
+    assert_valid_path(occupancy, path, (4, 0), (4, 4))
+
+    pathfinder.set_blocked([(0, 2)])
+    assert pathfinder.is_blocked((0, 2))
+    assert pathfinder.find_path((4, 0), (4, 4)) == (None, np.inf)
+    pathfinder.set_blocked([(0, 2)], blocked=False)
+    assert pathfinder.find_path((4, 0), (4, 4), jps=True)[1] == pytest.approx(cost)
+
+    path, cost = GridPathfinder(occupancy, diagonal=False).find_path((4, 0), (4, 4))
+    assert cost == 12 and len(path) == 13
+    with pytest.raises(Exception):
+        GridPathfinder(occupancy, diagonal=False).find_path((4, 0), (4, 4), jps=True)
+    with pytest.raises(Exception):
+        GridPathfinder(occupancy).find_path((4, 0), (4, 4), heuristic='manhattan')